@@ -1,25 +1,67 @@
 #!/usr/bin/env python3
 
 import argparse
+import time
 from pthr_db_caller.panther_tree_graph import PantherTreeGraph
+from pthr_db_caller.tree_cache import TreeCache
+from pthr_db_caller.tree_library import find_tree_files, process_tree_library, write_summary
 
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-t', '--tree_file')
 parser.add_argument('-o', '--out_file')
 parser.add_argument('-p', '--prune_species')
+parser.add_argument('-d', '--tree_dir', help="Convert every tree file in this directory (see --tree_glob) instead of"
+                                             " a single --tree_file, writing <family>.newick files to --out_dir")
+parser.add_argument('--tree_glob', default="*.tree", help="Tree file pattern within --tree_dir, e.g. '*/tree.tree'")
+parser.add_argument('--out_dir')
+parser.add_argument('-w', '--workers', type=int, help="Number of worker processes for --tree_dir. Defaults to the "
+                                                      "CPU count")
+parser.add_argument('-s', '--summary', help="With --tree_dir, write a TSV of per-family status, timing and errors "
+                                            "to this file")
+parser.add_argument('--cache_dir', help="Save parsed trees in this directory and load them from there on reruns, "
+                                        "while the tree files are unchanged")
+
+
+def read_taxon_list(prune_species_file):
+    taxon_list = []
+    with open(prune_species_file) as spf:
+        for l in spf.readlines():
+            taxon_list.append(l.rstrip())
+    return taxon_list
 
 
 if __name__ == "__main__":
     args = parser.parse_args()
-    tree = PantherTreeGraph.parse(tree_file=args.tree_file)
+    taxon_list = None
     if args.prune_species:
-        taxon_list = []
-        with open(args.prune_species) as spf:
-            for l in spf.readlines():
-                taxon_list.append(l.rstrip())
-        tree.prune_species(taxon_list=taxon_list)
-    if len(tree) > 0:
-        tree.write(args.out_file)
+        taxon_list = read_taxon_list(args.prune_species)
+    if args.tree_dir:
+        if not args.out_dir:
+            print("ERROR: --out_dir is required with --tree_dir")
+            exit()
+        start_time = time.perf_counter()
+        results = process_tree_library(find_tree_files(args.tree_dir, args.tree_glob), args.out_dir,
+                                       taxon_list=taxon_list, workers=args.workers, cache_dir=args.cache_dir)
+        for r in results:
+            if r["status"] == "error":
+                print("ERROR: {} - {}".format(r["message"], r["tree_file"]))
+            elif r["status"] == "empty":
+                print("ERROR: Empty tree so nothing to write - {}".format(r["tree_file"]))
+        if args.summary:
+            write_summary(results, args.summary)
+        status_counts = {status: len([r for r in results if r["status"] == status]) for status in ["ok", "empty", "error"]}
+        print("{} families in {:.2f}s: {} written, {} empty, {} errors".format(
+            len(results), time.perf_counter() - start_time, status_counts["ok"], status_counts["empty"],
+            status_counts["error"]))
     else:
-        print("ERROR: Empty tree so nothing to write - {}".format(args.tree_file))
+        if args.cache_dir:
+            tree = TreeCache(args.cache_dir).load(args.tree_file)
+        else:
+            tree = PantherTreeGraph.parse(tree_file=args.tree_file)
+        if taxon_list is not None:
+            tree.prune_species(taxon_list=taxon_list)
+        if len(tree) > 0:
+            tree.write(args.out_file)
+        else:
+            print("ERROR: Empty tree so nothing to write - {}".format(args.tree_file))
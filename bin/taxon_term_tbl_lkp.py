@@ -5,14 +5,18 @@ from pthr_db_caller.taxon_validate import TaxonTermValidator
 
 
 parser = argparse.ArgumentParser()
-parser.add_argument("-t", "--taxon_term_table")
+parser.add_argument("-t", "--taxon_term_table", help="Taxon-term table TSV, or a matrix (.npy) saved with --save_matrix")
 parser.add_argument('-n', '--taxon', type=str)
 parser.add_argument("-g", "--term", type=str)
+parser.add_argument("-m", "--save_matrix", help="Save the table as a bit-packed matrix (.npy) to load faster with -t")
 
 
 if __name__ == "__main__":
     args = parser.parse_args()
 
     validator = TaxonTermValidator(args.taxon_term_table)
-    result = validator.taxon_term_lookup(args.taxon, args.term)
-    print(result)
+    if args.save_matrix:
+        validator.save_constraint_matrix(args.save_matrix)
+    if args.taxon and args.term:
+        result = validator.taxon_term_lookup(args.taxon, args.term)
+        print(result)
@@ -0,0 +1,106 @@
+import asyncio
+import psycopg2
+import psycopg2.extensions
+from typing import List
+from pthr_db_caller.db_caller import DBCaller, DBCallerConfig
+
+DEFAULT_CONCURRENCY = 10
+
+
+async def wait_for(connection):
+    # Drive a psycopg2 async connection's poll() loop from the asyncio event loop
+    loop = asyncio.get_running_loop()
+    while True:
+        state = connection.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        ready = loop.create_future()
+        fileno = connection.fileno()
+        if state == psycopg2.extensions.POLL_READ:
+            loop.add_reader(fileno, lambda: ready.done() or ready.set_result(None))
+            try:
+                await ready
+            finally:
+                loop.remove_reader(fileno)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            loop.add_writer(fileno, lambda: ready.done() or ready.set_result(None))
+            try:
+                await ready
+            finally:
+                loop.remove_writer(fileno)
+        else:
+            raise psycopg2.OperationalError("Unexpected poll state: {}".format(state))
+
+
+class AsyncDBCaller:
+    """
+    asyncio counterpart of DBCaller built on psycopg2's asynchronous connections. Takes the same DBCallerConfig
+    and returns results shaped like DBCaller.exec_query (column names first, then rows). Async connections are
+    always in autocommit mode, so each statement is its own transaction.
+    """
+
+    def __init__(self, config: DBCallerConfig = None, concurrency=DEFAULT_CONCURRENCY):
+        # Sync caller used for its config and query variable binding
+        self.db_caller = DBCaller(config)
+        self.config = self.db_caller.config
+        self.concurrency = concurrency
+        self.idle_connections = []
+
+    async def get_connection(self):
+        if self.idle_connections:
+            return self.idle_connections.pop()
+        con = psycopg2.connect(self.db_caller.get_dsn(), async_=True)
+        await wait_for(con)
+        return con
+
+    def release_connection(self, con):
+        if con.closed:
+            return
+        self.idle_connections.append(con)
+
+    def close(self):
+        while self.idle_connections:
+            self.idle_connections.pop().close()
+
+    async def exec_query(self, connection, query, omit_header=True, params=None):
+        cursor = connection.cursor()
+        try:
+            cursor.execute(query, params)
+            await wait_for(connection)
+        except psycopg2.Error as e:
+            print(query)
+            print(e.__class__.__name__, ":", e.diag.message_primary)
+            raise e
+        if omit_header is None:
+            print(cursor.query.decode("utf-8"))
+        if cursor.description is None:
+            # Could be due to insert
+            print(cursor.statusmessage)
+            return []
+        res = cursor.fetchall()
+        colnames = [desc[0] for desc in cursor.description]
+        res.insert(0, colnames)
+        return res
+
+    async def run_query(self, raw_query, query_variables=None):
+        query, params = self.db_caller.bind_query(raw_query, query_variables=query_variables)
+        con = await self.get_connection()
+        try:
+            return await self.exec_query(con, query, params=params)
+        finally:
+            self.release_connection(con)
+
+    async def gather(self, coroutines, concurrency=None):
+        # asyncio.gather with at most concurrency coroutines (and so connections) in flight at once
+        semaphore = asyncio.Semaphore(concurrency or self.concurrency)
+
+        async def bounded(coroutine):
+            async with semaphore:
+                return await coroutine
+
+        return await asyncio.gather(*[bounded(c) for c in coroutines])
+
+    async def run_queries(self, raw_query, query_variables_list: List, concurrency=None):
+        # One statement run once per set of query variables, results returned in input order
+        return await self.gather([self.run_query(raw_query, qv) for qv in query_variables_list],
+                                 concurrency=concurrency)
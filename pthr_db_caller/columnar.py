@@ -0,0 +1,143 @@
+# Output formats supported by DBCaller.export_columnar. pyarrow (parquet, arrow) and numpy (npy) are optional
+#  dependencies, only imported when one of these formats is requested.
+COLUMNAR_FORMATS = ["parquet", "arrow", "npy"]
+OUTPUT_FORMATS = ["text"] + COLUMNAR_FORMATS
+
+# Postgres type OIDs, as found in cursor.description type_code
+BOOL_OID = 16
+INT8_OID = 20
+INT2_OID = 21
+INT4_OID = 23
+FLOAT4_OID = 700
+FLOAT8_OID = 701
+NUMERIC_OID = 1700
+DATE_OID = 1082
+TIMESTAMP_OID = 1114
+TIMESTAMPTZ_OID = 1184
+
+NUMPY_DTYPES = {
+    BOOL_OID: "?",
+    INT2_OID: "i2",
+    INT4_OID: "i4",
+    INT8_OID: "i8",
+    FLOAT4_OID: "f4",
+    FLOAT8_OID: "f8",
+    NUMERIC_OID: "f8",
+    DATE_OID: "datetime64[D]",
+    TIMESTAMP_OID: "datetime64[us]",
+}
+
+
+def import_optional(module_name, output_format):
+    try:
+        return __import__(module_name, fromlist=["_"])
+    except ImportError:
+        raise ImportError("'{}' output requires the {} package to be installed".format(output_format,
+                                                                                       module_name.split(".")[0]))
+
+
+def arrow_type(pa, type_code):
+    arrow_types = {
+        BOOL_OID: pa.bool_(),
+        INT2_OID: pa.int16(),
+        INT4_OID: pa.int32(),
+        INT8_OID: pa.int64(),
+        FLOAT4_OID: pa.float32(),
+        FLOAT8_OID: pa.float64(),
+        NUMERIC_OID: pa.float64(),
+        DATE_OID: pa.date32(),
+        TIMESTAMP_OID: pa.timestamp("us"),
+        TIMESTAMPTZ_OID: pa.timestamp("us", tz="UTC"),
+    }
+    return arrow_types.get(type_code, pa.string())
+
+
+def column_values(column, type_code):
+    # Python values the array constructors can't take directly: Decimal for numeric, anything not mapped
+    #  to a native column type (e.g. arrays, intervals) ends up as text
+    if type_code == NUMERIC_OID:
+        return [None if v is None else float(v) for v in column]
+    if type_code in NUMPY_DTYPES or type_code == TIMESTAMPTZ_OID:
+        return column
+    return [v if v is None or isinstance(v, str) else str(v) for v in column]
+
+
+class ColumnarResultWriter:
+    """
+    Writes one result set batch by batch to a parquet, arrow (IPC file) or npy file, typing columns from the
+    cursor description.
+
+    parquet and arrow are written incrementally. npy needs its shape and fixed string widths up front, so its
+    batches are kept as compact numpy structured arrays and saved on close(). In npy output, NULLs become NaN/NaT
+    in float/date columns, '' in text and False in bool columns; integer columns containing NULLs become floats.
+    """
+
+    def __init__(self, filename, output_format, description):
+        if output_format not in COLUMNAR_FORMATS:
+            raise ValueError("Unknown columnar format '{}'".format(output_format))
+        self.filename = filename
+        self.output_format = output_format
+        self.colnames = [desc[0] for desc in description]
+        self.type_codes = [desc[1] for desc in description]
+        self.row_count = 0
+        self.writer = None
+        self.npy_batches = []
+        if output_format == "npy":
+            self.np = import_optional("numpy", output_format)
+        else:
+            self.pa = import_optional("pyarrow", output_format)
+            self.schema = self.pa.schema([(n, arrow_type(self.pa, t)) for n, t in zip(self.colnames, self.type_codes)])
+            if output_format == "parquet":
+                pq = import_optional("pyarrow.parquet", output_format)
+                self.writer = pq.ParquetWriter(filename, self.schema)
+            else:
+                self.writer = self.pa.ipc.new_file(filename, self.schema)
+
+    def write_batch(self, rows):
+        if not rows:
+            return
+        columns = list(zip(*rows))
+        if self.output_format == "npy":
+            self.npy_batches.append(self.npy_batch(columns))
+        else:
+            arrays = [self.pa.array(column_values(c, t), type=f.type)
+                      for c, t, f in zip(columns, self.type_codes, self.schema)]
+            self.writer.write_batch(self.pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+        self.row_count += len(rows)
+
+    def npy_batch(self, columns):
+        np = self.np
+        arrays = []
+        for column, type_code in zip(columns, self.type_codes):
+            dtype = NUMPY_DTYPES.get(type_code)
+            values = column_values(column, type_code)
+            if dtype is None:
+                arrays.append(np.array(["" if v is None else v for v in values], dtype="U"))
+            elif None in values:
+                if dtype == "?":
+                    arrays.append(np.array([bool(v) for v in values], dtype=dtype))
+                elif dtype.startswith("datetime64"):
+                    arrays.append(np.array(["NaT" if v is None else v for v in values], dtype=dtype))
+                else:
+                    arrays.append(np.array([np.nan if v is None else v for v in values], dtype="f8"))
+            else:
+                arrays.append(np.array(values, dtype=dtype))
+        batch = np.empty(len(columns[0]), dtype=[(n, a.dtype) for n, a in zip(self.colnames, arrays)])
+        for name, array in zip(self.colnames, arrays):
+            batch[name] = array
+        return batch
+
+    def close(self):
+        if self.output_format == "npy":
+            np = self.np
+            if self.npy_batches:
+                dtype = [(n, np.result_type(*[b.dtype[n] for b in self.npy_batches])) for n in self.colnames]
+                result = np.concatenate([b.astype(dtype) for b in self.npy_batches])
+            else:
+                result = np.empty(0, dtype=[(n, NUMPY_DTYPES.get(t, "U1")) for n, t in zip(self.colnames, self.type_codes)])
+            with open(self.filename, "wb") as npy_f:
+                np.save(npy_f, result)
+            self.npy_batches = []
+        elif self.writer is not None:
+            self.writer.close()
+            self.writer = None
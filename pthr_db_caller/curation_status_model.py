@@ -1,3 +1,5 @@
+from typing import List
+from psycopg2 import sql
 from pthr_db_caller.db_caller import DBCaller
 
 
@@ -19,9 +21,10 @@ class PaintCurationStatusHelper:
         select classification_id from panther_upl.classification
         where classification_version_sid = {classification_version_sid}
         and accession = '{family_id}';
-        """.format(classification_version_sid=self.classification_version_sid, family_id=family_id)
+        """
 
-        results = self.db_caller.run_cmd_line_args(query.rstrip(), no_header_footer=True)
+        results = self.db_caller.run_query(query.rstrip(), {"classification_version_sid": self.classification_version_sid,
+                                                            "family_id": family_id})
         if len(results[1:]) > 0:
             return results[1][0]
         else:
@@ -36,7 +39,30 @@ class PaintCurationStatusHelper:
         (curation_status_id, status_type_sid, classification_id, user_id, 
             creation_date)
         VALUES (nextval('uids'), {status_id}, {family_cls_id}, 1113, now())
-        """.format(curation_status_tablename=self.curation_status_tablename, status_id=status_id,
-                   family_cls_id=family_cls_id)
+        """
 
-        self.db_caller.run_cmd_line_args(query.rstrip(), no_header_footer=True)
+        self.db_caller.run_query(query.rstrip(), {"curation_status_tablename": self.curation_status_tablename,
+                                                  "status_id": status_id, "family_cls_id": family_cls_id})
+
+    def insert_curation_statuses(self, family_ids: List[str], status_id):
+        # Bulk version of insert_curation_status as one joined INSERT ... SELECT against panther_upl.classification.
+        #  Returns the family IDs that have no classification (and so got no curation_status row).
+        query = sql.SQL("""
+        with families as (
+            select accession, classification_id from panther_upl.classification
+            where classification_version_sid = %s
+            and accession = any(%s)
+        ), inserted as (
+            INSERT INTO panther_upl.{curation_status_tablename}
+            (curation_status_id, status_type_sid, classification_id, user_id,
+                creation_date)
+            select nextval('uids'), %s, classification_id, 1113, now() from families
+        )
+        select accession from families;
+        """).format(curation_status_tablename=sql.Identifier(self.curation_status_tablename))
+
+        with self.db_caller.connection() as con:
+            cursor = con.cursor()
+            cursor.execute(query, (self.classification_version_sid, list(family_ids), status_id))
+            found_families = set(r[0] for r in cursor.fetchall())
+        return [f for f in family_ids if f not in found_families]
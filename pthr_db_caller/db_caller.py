@@ -1,10 +1,46 @@
 import psycopg2
+import psycopg2.extras
+import psycopg2.pool
 import yaml
 import json
 import argparse
+import sys
 import datetime
+import itertools
+import re
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from os import path
 from sys import exit
+from pthr_db_caller.query_cache import QueryResultCache, DEFAULT_TTL
+from pthr_db_caller.query_profile import QueryProfileLog, new_profile
+from pthr_db_caller.columnar import ColumnarResultWriter, COLUMNAR_FORMATS, OUTPUT_FORMATS
+
+DEFAULT_ITERSIZE = 2000
+FORMAT_BATCH_SIZE = 2000  # Rows formatted and written per write_results output chunk
+# Column value types whose str() is the same for all equal values, so repeats can be converted once per batch.
+#  Not float (-0.0 == 0.0), Decimal (1.10 == 1.1) or datetime (equal instants in different time zones).
+DEDUP_FORMAT_TYPES = {int, bool, datetime.date}
+SELECT_STATEMENT_PATTERN = re.compile(r"^\s*\(?\s*(select|with|values|table)\b", re.IGNORECASE)
+STREAM_CURSOR_IDS = itertools.count()
+DEFAULT_POOL_MINCONN = 1
+DEFAULT_POOL_MAXCONN = 10
+WRITE_KEYWORD_PATTERN = re.compile(r"\b(insert|update|delete|merge|into|nextval|setval|for\s+update|for\s+share)\b", re.IGNORECASE)
+PREPARABLE_STATEMENT_PATTERN = re.compile(r"^\s*\(?\s*(select|with|values|insert|update|delete|merge)\b", re.IGNORECASE)
+# Quoted literals, quoted identifiers, dollar-quoted strings, doubled braces or {var} placeholders, scanned in
+#  order by DBCaller.bind_query
+PLACEHOLDER_TOKEN_PATTERN = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|\$(?P<tag>(?:[A-Za-z_]\w*)?)\$[\s\S]*?\$(?P=tag)\$|"
+                                       r"\{\{|\}\}|\{(?P<name>\w*)\}")
+PLACEHOLDER_PATTERN = re.compile(r"\{\{|\}\}|\{(\w*)\}")
+# Placeholders right after a comparison operator or these keywords hold a value, so can be bound
+VALUE_POSITION_PATTERN = re.compile(r"([=<>]|\b(limit|offset|like|ilike))\s*$", re.IGNORECASE)
+VALUES_LIST_PATTERN = re.compile(r"\bvalues\s*\(", re.IGNORECASE)
+NUMBERED_PARAM_PATTERN = re.compile(r"%(%|s)")
+PARALLEL_ANNOTATION_PATTERN = re.compile(r"^\s*--\s*@parallel\b\s*(\S*)")
+CONNECTION_PROPERTIES = ["id", "host", "dbname", "username", "pword", "pool_minconn", "pool_maxconn"]
 
 parser = argparse.ArgumentParser()
 parser.add_argument("query_filename")
@@ -14,6 +50,29 @@ parser.add_argument("-v", "--query_variables", type=str, required=False, help="c
 parser.add_argument("-o", "--rows_outfile", help="Write result rows to specified filename.")
 parser.add_argument("-d", "--delimiter", help="column delimiter to display in query output.")
 parser.add_argument("-n", "--no_header_footer", action='store_const', const=True, help="No header or footer will be included in query result output")
+parser.add_argument("-s", "--stream", action='store_const', const=True, help="Stream SELECT results through a server-side cursor instead of loading all rows into memory")
+parser.add_argument("-c", "--copy_export", action='store_const', const=True, help="Export SELECT results written to --rows_outfile with COPY ... TO STDOUT (server-formatted CSV)")
+parser.add_argument("-p", "--parallel_workers", type=int, help="Run consecutive statements annotated with the same '-- @parallel <group>' comment concurrently on this many connections")
+parser.add_argument("-b", "--bind_variables", action='store_const', const=True, help="Send {var} placeholder values as bound query parameters instead of substituting them into the SQL text")
+parser.add_argument("--format", dest="output_format", choices=OUTPUT_FORMATS, default="text", help="Format of SELECT results written to --rows_outfile. Columnar formats write each further result set to <name>.<n>.<ext>")
+parser.add_argument("--profile_log", help="Append a JSON line per statement with execute/fetch/format timings, rows and bytes to this file")
+parser.add_argument("--explain", action='store_const', const=True, help="With --profile_log, also record EXPLAIN (ANALYZE, BUFFERS) for read-only statements. Note these statements then run twice")
+parser.add_argument("--cache_dir", help="Cache results of read-only statements in this directory and reuse them on reruns")
+parser.add_argument("--cache_ttl", type=int, default=DEFAULT_TTL, help="Seconds a cached result stays valid (default: {})".format(DEFAULT_TTL))
+parser.add_argument("--itersize", type=int, default=DEFAULT_ITERSIZE, help="Number of rows fetched per round trip when streaming (default: {})".format(DEFAULT_ITERSIZE))
+
+
+def is_select_statement(query):
+    # Server-side (named) cursors and COPY (...) TO can only be used for plain row-returning statements, not
+    #  SELECT INTO or a WITH containing insert/update/delete. Anything mentioning a write keyword is left to
+    #  exec_query.
+    return SELECT_STATEMENT_PATTERN.match(query) is not None and WRITE_KEYWORD_PATTERN.search(query) is None
+
+
+def is_read_only_statement(query):
+    # Conservative: SELECT-like statements that don't mention anything that writes or locks
+    return is_select_statement(query)
+
 
 class DBCallerConfig:
     def __init__(self, config_path="config/config.yaml"):
@@ -33,38 +92,129 @@ class DBCallerConfig:
         self.dbname = chosen_df["dbname"]
         self.username = chosen_df["username"]
         self.pword = chosen_df["pword"]
+        # Optional connection pool sizing
+        self.pool_minconn = int(chosen_df.get("pool_minconn", DEFAULT_POOL_MINCONN))
+        self.pool_maxconn = int(chosen_df.get("pool_maxconn", DEFAULT_POOL_MAXCONN))
         
         # Beyond the above DB connection properties, any other properties in a DB definition 
         #  will be handled as query variables.
         self.query_variables = {}
         for k, v in chosen_df.items():
-            if k in ["id", "host", "dbname", "username", "pword"]:
+            if k in CONNECTION_PROPERTIES:
                 continue
             else:
                 self.query_variables[k] = v
 
 
+class PooledConnection:
+    # Stand-in for a connection handed out by DBCaller.connection(). The real connection is only borrowed
+    #  from the pool when first used, so runs answered entirely from the result cache never connect.
+    def __init__(self, db_caller):
+        self.db_caller = db_caller
+        self.con = None
+
+    def __getattr__(self, name):
+        if self.con is None:
+            self.con = self.db_caller.get_pool().getconn()
+        return getattr(self.con, name)
+
+    def commit(self):
+        if self.con is not None:
+            self.con.commit()
+
+    def rollback(self):
+        if self.con is not None and not self.con.closed:
+            self.con.rollback()
+
+    def release(self):
+        if self.con is not None:
+            self.db_caller.get_pool().putconn(self.con, close=bool(self.con.closed))
+            self.con = None
+
+
 class DBCaller:
-    def __init__(self, config=None):
+    def __init__(self, config=None, cache: QueryResultCache = None):
         self.config = config
         if self.config is None:
             self.config = DBCallerConfig()
+        # Optional on-disk cache consulted by exec_query for read-only statements
+        self.cache = cache
+        # Created on first use of connection() and shared by all threads using this caller
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        # {connection: {query: prepared statement name}} - prepared statements live as long as their session
+        self.prepared_statements = weakref.WeakKeyDictionary()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get_dsn(self):
+        return "dbname = {} user={} host={} password={}".format(self.config.dbname,
+                                                               self.config.username,
+                                                               self.config.host,
+                                                               self.config.pword)
 
     def get_connection(self):
-        con = psycopg2.connect("dbname = {} user={} host={} password={}".format(self.config.dbname,
-                                                                                self.config.username,
-                                                                                self.config.host,
-                                                                                self.config.pword))
+        con = psycopg2.connect(self.get_dsn())
         return con
 
-    def exec_query(self, connection, query, omit_header=None):
+    def get_pool(self):
+        with self.pool_lock:
+            if self.pool is None or self.pool.closed:
+                self.pool = psycopg2.pool.ThreadedConnectionPool(self.config.pool_minconn,
+                                                                 self.config.pool_maxconn,
+                                                                 self.get_dsn())
+        return self.pool
+
+    @contextmanager
+    def connection(self):
+        # Borrow a pooled connection, committing on success and rolling back on error before handing it back
+        con = PooledConnection(self)
+        try:
+            yield con
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+        finally:
+            con.release()
+
+    def close(self):
+        with self.pool_lock:
+            if self.pool is not None and not self.pool.closed:
+                self.pool.closeall()
+            self.pool = None
+
+    def exec_query(self, connection, query, omit_header=None, params=None, prepare=None, profile=None):
+        # params are bound to %s placeholders in query (see bind_query). With prepare set, the statement is
+        #  PREPAREd once per connection and then EXECUTEd, so repeated runs with new params skip planning.
+        # profile (see query_profile.new_profile) gets the execute and fetch timings if passed.
+        cache_key = None
+        if self.cache is not None and is_read_only_statement(query):
+            cache_key = self.cache.key(self.config, query, params=params)
+            res = self.cache.get(cache_key)
+            if res is not None:
+                if omit_header is None:
+                    print(query, "(cached)")
+                if profile is not None:
+                    profile["cached"] = True
+                return res
         cursor = connection.cursor()
+        execute_start = time.perf_counter()
         try:
-            cursor.execute(query)
+            if prepare and PREPARABLE_STATEMENT_PATTERN.match(query):
+                self.execute_prepared(cursor, query, params)
+            else:
+                cursor.execute(query, params)
         except psycopg2.Error as e:
             print(query)
             print(e.__class__.__name__, ":", e.diag.message_primary)
             raise e
+        fetch_start = time.perf_counter()
+        rowcount = cursor.rowcount
         if omit_header is None:
             print(cursor.query.decode("utf-8"))
         try:
@@ -75,10 +225,172 @@ class DBCaller:
             # Could be due to insert
             print(cursor.statusmessage)
             res = []
+        if profile is not None:
+            profile["execute_seconds"] += fetch_start - execute_start
+            profile["fetch_seconds"] += time.perf_counter() - fetch_start
+            if not res:
+                profile["rows"] = rowcount
+        if cache_key is not None and res:
+            self.cache.set(cache_key, res)
         return res
 
-    def format_results(self, results, delimiter=";"):
-        formatted_results = []
+    def execute_prepared(self, cursor, query, params=None):
+        prepared = self.prepared_statements.setdefault(cursor.connection, {})
+        statement_name = prepared.get(query)
+        if statement_name is None:
+            statement_name = "pthr_db_caller_{}".format(len(prepared))
+            prepare_query = query.rstrip().rstrip(";")
+            if params:
+                # %s placeholders become $1, $2, ... and %% escapes are undone. Without params the text has no
+                #  placeholders or escapes (see bind_query), so any '%s' in it is literal.
+                numbered_params = itertools.count(1)
+                prepare_query = NUMBERED_PARAM_PATTERN.sub(
+                    lambda m: "%" if m.group(1) == "%" else "${}".format(next(numbered_params)), prepare_query
+                )
+            cursor.execute("PREPARE {} AS {}".format(statement_name, prepare_query))
+            prepared[query] = statement_name
+        if params:
+            cursor.execute("EXECUTE {} ({});".format(statement_name, ", ".join(["%s"] * len(params))), params)
+        else:
+            cursor.execute("EXECUTE {};".format(statement_name))
+
+    def exec_many(self, connection, raw_query, query_variables_list, page_size=100):
+        # Runs one statement for each set of query variables as a single prepared statement, e.g. per-family
+        #  inserts. Every set must bind to the same SQL text.
+        bound_queries = [self.bind_query(raw_query, query_variables=qv) for qv in query_variables_list]
+        if not bound_queries:
+            return
+        query = bound_queries[0][0]
+        if any(bq[0] != query for bq in bound_queries):
+            raise ValueError("Query variables do not all bind to the same statement")
+        cursor = connection.cursor()
+        self.execute_prepared(cursor, query, bound_queries[0][1])
+        param_count = len(bound_queries[0][1] or [])
+        execute_query = "EXECUTE {}".format(self.prepared_statements[cursor.connection][query])
+        if param_count:
+            execute_query += " ({})".format(", ".join(["%s"] * param_count))
+        psycopg2.extras.execute_batch(cursor, execute_query, [bq[1] for bq in bound_queries[1:]], page_size=page_size)
+
+    def run_query(self, raw_query, query_variables=None, prepare=True):
+        # Single statement with {var} placeholders bound as parameters, run on a pooled connection. Returns
+        #  exec_query results (column names first).
+        query, params = self.bind_query(raw_query, query_variables=query_variables)
+        with self.connection() as con:
+            return self.exec_query(con, query, omit_header=True, params=params, prepare=prepare)
+
+    def exec_query_stream(self, connection, query, omit_header=None, itersize=DEFAULT_ITERSIZE, params=None, profile=None):
+        # Same result shape as exec_query (column names first, then rows) but yielded lazily from a
+        #  server-side cursor, so only itersize rows are held in memory at any time.
+        cursor = connection.cursor(name="pthr_db_caller_stream_{}".format(next(STREAM_CURSOR_IDS)))
+        cursor.itersize = itersize
+        execute_start = time.perf_counter()
+        try:
+            cursor.execute(query, params)
+        except psycopg2.Error as e:
+            print(query)
+            print(e.__class__.__name__, ":", e.diag.message_primary)
+            raise e
+        if profile is not None:
+            profile["execute_seconds"] += time.perf_counter() - execute_start
+        if omit_header is None:
+            print(cursor.query.decode("utf-8"))
+        try:
+            rows = iter(cursor)
+            fetch_start = time.perf_counter()
+            first_row = next(rows, None)  # cursor.description is only filled after the first fetch
+            if profile is not None:
+                profile["fetch_seconds"] += time.perf_counter() - fetch_start
+            yield [desc[0] for desc in cursor.description]
+            if first_row is not None:
+                yield first_row
+                if profile is None:
+                    yield from rows
+                else:
+                    while True:
+                        fetch_start = time.perf_counter()
+                        row = next(rows, None)
+                        profile["fetch_seconds"] += time.perf_counter() - fetch_start
+                        if row is None:
+                            break
+                        yield row
+        finally:
+            cursor.close()
+
+    def copy_export(self, connection, query, rows_outfile, delimiter=";", omit_header=None, params=None, profile=None):
+        # Server-side CSV rendering streamed straight into rows_outfile. Unlike format_results, values are
+        #  formatted by Postgres (e.g. booleans as t/f) and CSV quoting is applied to fields containing the
+        #  delimiter, quotes or newlines. The column name header line is kept. Returns the number of lines written.
+        delimiter = delimiter.encode().decode('unicode_escape')  # Required for "\t"-delimiting
+        cursor = connection.cursor()
+        if params:
+            query = cursor.mogrify(query, params).decode("utf-8")  # COPY doesn't take parameters
+        copy_query = "COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER true, DELIMITER {})".format(
+            query.rstrip().rstrip(";"), psycopg2.extensions.QuotedString(delimiter).getquoted().decode("utf-8"))
+        execute_start = time.perf_counter()
+        outfile_start = rows_outfile.tell()
+        try:
+            cursor.copy_expert(copy_query, rows_outfile)
+        except psycopg2.Error as e:
+            print(copy_query)
+            print(e.__class__.__name__, ":", e.diag.message_primary)
+            raise e
+        if profile is not None:
+            profile["execute_seconds"] += time.perf_counter() - execute_start
+            profile["bytes"] += rows_outfile.tell() - outfile_start
+        if omit_header is None:
+            print(copy_query)
+        return cursor.rowcount + 1
+
+    def export_columnar(self, connection, query, filename, output_format, omit_header=None, itersize=DEFAULT_ITERSIZE,
+                        params=None, profile=None):
+        # Fetches itersize rows at a time from a server-side cursor into a ColumnarResultWriter, typing columns
+        #  from the cursor description. Returns the number of rows plus one, like the header-inclusive line counts.
+        cursor = connection.cursor(name="pthr_db_caller_stream_{}".format(next(STREAM_CURSOR_IDS)))
+        timings = {"execute_seconds": 0.0, "fetch_seconds": 0.0, "format_seconds": 0.0}
+        execute_start = time.perf_counter()
+        try:
+            cursor.execute(query, params)
+        except psycopg2.Error as e:
+            print(query)
+            print(e.__class__.__name__, ":", e.diag.message_primary)
+            raise e
+        timings["execute_seconds"] += time.perf_counter() - execute_start
+        if omit_header is None:
+            print(cursor.query.decode("utf-8"))
+        try:
+            fetch_start = time.perf_counter()
+            rows = cursor.fetchmany(itersize)
+            timings["fetch_seconds"] += time.perf_counter() - fetch_start
+            writer = ColumnarResultWriter(filename, output_format, cursor.description)
+            try:
+                while rows:
+                    format_start = time.perf_counter()
+                    writer.write_batch(rows)
+                    fetch_start = time.perf_counter()
+                    rows = cursor.fetchmany(itersize)
+                    timings["format_seconds"] += fetch_start - format_start
+                    timings["fetch_seconds"] += time.perf_counter() - fetch_start
+            finally:
+                format_start = time.perf_counter()
+                writer.close()
+                timings["format_seconds"] += time.perf_counter() - format_start
+        finally:
+            cursor.close()
+        if profile is not None:
+            for timing, seconds in timings.items():
+                profile[timing] += seconds
+            if path.isfile(filename):
+                profile["bytes"] += path.getsize(filename)
+        return writer.row_count + 1
+
+    @staticmethod
+    def columnar_outfile_name(rows_outfile, result_set_index):
+        if result_set_index == 0:
+            return rows_outfile
+        root, ext = path.splitext(rows_outfile)
+        return "{}.{}{}".format(root, result_set_index, ext)
+
+    def iter_format_results(self, results, delimiter=";"):
         delimiter = delimiter.encode().decode('unicode_escape')  # Required for "\t"-delimiting
         for r in results:
             vals = []
@@ -88,8 +400,63 @@ class DBCaller:
                 else:
                     val = str(val)
                 vals.append(val)
-            formatted_results.append(delimiter.join(vals))
-        return formatted_results
+            yield delimiter.join(vals)
+
+    def format_results(self, results, delimiter=";"):
+        return list(self.iter_format_results(results, delimiter=delimiter))
+
+    @staticmethod
+    def format_column(column):
+        # str() for each value, None as ''. Decided once for the whole column rather than per value.
+        column_types = set(map(type, column))
+        if column_types == {str}:
+            return column
+        if column_types == {str, type(None)}:
+            return ['' if val is None else val for val in column]
+        value_types = column_types - {type(None)}
+        if len(value_types) == 1 and value_types <= DEDUP_FORMAT_TYPES:
+            distinct_vals = set(column)
+            if len(distinct_vals) * 2 < len(column):
+                val_strs = {val: '' if val is None else str(val) for val in distinct_vals}
+                return list(map(val_strs.__getitem__, column))
+        if type(None) in column_types:
+            return ['' if val is None else str(val) for val in column]
+        return list(map(str, column))
+
+    def format_batch(self, rows, delimiter):
+        # Same text as iter_format_results, one line per row, built a column at a time
+        row_lengths = set(map(len, rows))
+        if len(row_lengths) != 1 or 0 in row_lengths:
+            return "".join([delimiter.join(['' if val is None else str(val) for val in r]) + "\n" for r in rows])
+        columns = [self.format_column(column) for column in zip(*rows)]
+        return "\n".join(map(delimiter.join, zip(*columns))) + "\n"
+
+    def write_results(self, results, rows_outfile=None, delimiter=None, profile=None):
+        # Consumes results incrementally, FORMAT_BATCH_SIZE rows per write, and returns the number of lines
+        #  written (header included)
+        if delimiter is None:
+            delimiter = ";"
+        delimiter = delimiter.encode().decode('unicode_escape')  # Required for "\t"-delimiting
+        if not rows_outfile:
+            rows_outfile = sys.stdout
+        line_count = 0
+        if profile is not None:
+            # Time spent pulling rows out of a streaming results generator is fetch, not format, time
+            write_start = time.perf_counter()
+            fetch_seconds_before = profile["fetch_seconds"]
+        results = iter(results)
+        rows = list(itertools.islice(results, FORMAT_BATCH_SIZE))
+        while rows:
+            formatted = self.format_batch(rows, delimiter)
+            rows_outfile.write(formatted)
+            line_count += len(rows)
+            if profile is not None:
+                profile["bytes"] += len(formatted.encode("utf-8"))
+            rows = list(itertools.islice(results, FORMAT_BATCH_SIZE))
+        if profile is not None:
+            profile["format_seconds"] += time.perf_counter() - write_start - \
+                (profile["fetch_seconds"] - fetch_seconds_before)
+        return line_count
 
     def handle_config_variables(self, raw_query):
         cleaned_query = raw_query
@@ -121,6 +488,131 @@ class DBCaller:
             exit()
         return cleaned_query
 
+    def bind_query(self, raw_query, query_variables=None):
+        # Parameterized counterpart of clean_query returning (query, params). Only placeholders that surely hold
+        #  a value become %s parameters: a whole '{var}' literal, or {var} after a comparison operator,
+        #  LIMIT/OFFSET or LIKE, or as an item of a VALUES list. Everywhere else (names, select lists,
+        #  ORDER/GROUP BY, IN lists, quoted identifiers, longer literals like '{load_dir}/file.tsv') the value is
+        #  substituted into the text as clean_query does. params is None if nothing was bound.
+        if raw_query.lstrip().startswith("--"):
+            return None, None
+        statement_var_count = raw_query.count("{}")
+        positional_values = None
+        named_values = {}
+        if query_variables and query_variables.__class__ == dict:
+            named_values = query_variables
+        elif statement_var_count > 0:
+            if not query_variables:
+                print(raw_query)
+                print("ERROR: {} variables detected in statement but no variables provided".format(statement_var_count))
+                exit()
+            if statement_var_count != len(query_variables):
+                print("ERROR: Non-matching number of variables in statement ({}) to number of variables provided ({})".format(statement_var_count, len(query_variables)))
+                exit()
+            positional_values = iter(query_variables)
+
+        def lookup(name):
+            # Returns (found, value). Unlike clean_query, per-call variables win over config ones.
+            if name == "":
+                return True, next(positional_values)
+            if name in named_values:
+                return True, named_values[name]
+            if name in self.config.query_variables:
+                return True, self.config.query_variables[name]
+            return False, None
+
+        # clean_query's str.format also turns {{ and }} into single braces
+        unescape_braces = bool(query_variables) and (query_variables.__class__ == dict or statement_var_count > 0)
+
+        def substitute(match):
+            if match.group(0) in ("{{", "}}"):
+                return match.group(0)[0] if unescape_braces else match.group(0)
+            found, value = lookup(match.group(1))
+            return str(value) if found else match.group(0)
+
+        query_parts = []
+        params = []
+        last_end = 0
+        for token in PLACEHOLDER_TOKEN_PATTERN.finditer(raw_query):
+            query_parts.append(raw_query[last_end:token.start()].replace("%", "%%"))
+            last_end = token.end()
+            token_text = token.group(0)
+            if token_text in ("{{", "}}"):
+                query_parts.append(substitute(token))
+                continue
+            if token_text.startswith("$") or token_text.startswith('"'):
+                # Quoted identifier, or dollar-quoted body (e.g. a function) where a bound parameter would be
+                #  inlined as a quoted value
+                query_parts.append(PLACEHOLDER_PATTERN.sub(substitute, token_text).replace("%", "%%"))
+                continue
+            if token_text.startswith("'"):
+                literal_placeholder = PLACEHOLDER_PATTERN.fullmatch(token_text[1:-1])
+                found, value = (False, None)
+                if literal_placeholder and literal_placeholder.group(1) is not None:
+                    found, value = lookup(literal_placeholder.group(1))
+                if found:
+                    query_parts.append("%s")
+                    params.append(str(value))
+                else:
+                    query_parts.append(PLACEHOLDER_PATTERN.sub(substitute, token_text).replace("%", "%%"))
+                continue
+            found, value = lookup(token.group("name"))
+            if not found:
+                query_parts.append(token_text)
+            elif self.is_value_position(raw_query[:token.start()], raw_query[token.end():]):
+                query_parts.append("%s")
+                params.append(value)
+            else:
+                query_parts.append(str(value).replace("%", "%%"))
+        query_parts.append(raw_query[last_end:].replace("%", "%%"))
+        bound_query = "".join(query_parts)
+        if not params:
+            return bound_query.replace("%%", "%"), None
+        return bound_query, params
+
+    @staticmethod
+    def is_value_position(preceding_text, following_text):
+        # Whether a placeholder between these texts stands alone as a value, per bind_query
+        if re.match(r"[\w.{\"]", following_text[:1]):
+            # Touching a name or another placeholder
+            return False
+        following_text = following_text.lstrip()
+        if VALUE_POSITION_PATTERN.search(preceding_text):
+            return True
+        # VALUES list item: directly inside one of the list's parenthesized rows, between '(' or ',' and ',' or ')'
+        values_lists = list(VALUES_LIST_PATTERN.finditer(preceding_text))
+        if not values_lists or preceding_text.rstrip()[-1:] not in ("(", ",") or following_text[:1] not in (",", ")"):
+            return False
+        row_text = preceding_text[values_lists[-1].end():]
+        return row_text.count("(") - row_text.count(")") == 0
+
+    def split_statement_groups(self, raw_file_text):
+        # Returns [(group_name, [statement, ...]), ...] in file order. A statement preceded by a
+        #  '-- @parallel <group>' comment line joins the group of the consecutive statements annotated with the
+        #  same name. Unannotated statements each get their own sequential (group_name=None) group.
+        # Statements are split from the comment-free text, as in the sequential path (clean_file), so a ';' in a
+        #  comment doesn't split a statement. Annotations are recorded by statement number on the way.
+        noncommented_lines = []
+        statement_number = 0
+        annotations = {}
+        for line in raw_file_text.split("\n"):
+            annotation = PARALLEL_ANNOTATION_PATTERN.match(line)
+            if annotation:
+                annotations[statement_number] = annotation.group(1) or "default"
+            if not line.lstrip().startswith("--") and line != "":
+                noncommented_lines.append(line)
+                statement_number += line.count(";")
+        statement_groups = []
+        for i, statement in enumerate("\n".join(noncommented_lines).split(";")):
+            if not statement:
+                continue
+            group_name = annotations.get(i)
+            if group_name and statement_groups and statement_groups[-1][0] == group_name:
+                statement_groups[-1][1].append(statement)
+            else:
+                statement_groups.append((group_name, [statement]))
+        return statement_groups
+
     def clean_file(self, raw_file_text):
         noncommented_lines = []
         for line in raw_file_text.split("\n"):
@@ -129,7 +621,129 @@ class DBCaller:
         cleaned_file = "\n".join(noncommented_lines)
         return cleaned_file
 
-    def run_cmd_line_args(self, query_filename, query_variables=None, rows_outfile=None, delimiter=None, no_header_footer=None):
+    def explain_analyze(self, con, query, params=None):
+        # Runs the statement under EXPLAIN (ANALYZE, BUFFERS) and returns the JSON plan, server timings included
+        cursor = con.cursor()
+        cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query, params)
+        return cursor.fetchone()[0][0]
+
+    def log_profile(self, profile_log, profile, line_count, start_time):
+        profile["total_seconds"] = time.perf_counter() - start_time
+        if line_count > 0:
+            profile["rows"] = line_count - 1
+        profile_log.write(profile, config=self.config)
+
+    def print_footer(self, line_count, execution_time):
+        if line_count > 0:    # Display row count unless insert, update, set, etc.
+            print("Rows returned:", line_count - 1)
+        print("Execution time:", execution_time, "- Host:", self.config.host, "- DB:", self.config.dbname)
+
+    def run_statement(self, con, cleaned_query, rows_outfile=None, delimiter=None, no_header_footer=None,
+                      stream=None, itersize=DEFAULT_ITERSIZE, copy_export=None, params=None, output_format=None,
+                      columnar_outfile=None, profile_log: QueryProfileLog = None, explain=None):
+        start_time = datetime.datetime.now()
+        profile_start = time.perf_counter()
+        profile = None
+        if profile_log is not None and explain and is_read_only_statement(cleaned_query):
+            explain_plan = self.explain_analyze(con, cleaned_query, params=params)
+        if output_format in COLUMNAR_FORMATS and columnar_outfile and is_select_statement(cleaned_query):
+            if profile_log is not None:
+                profile = new_profile(cleaned_query, output_format)
+            results = []
+            line_count = self.export_columnar(con, cleaned_query + ";", columnar_outfile, output_format,
+                                              omit_header=no_header_footer, itersize=itersize, params=params,
+                                              profile=profile)
+        elif copy_export and rows_outfile and is_select_statement(cleaned_query) and \
+                len((delimiter or ";").encode().decode('unicode_escape')) == 1:
+            if profile_log is not None:
+                profile = new_profile(cleaned_query, "copy")
+            results = []
+            line_count = self.copy_export(con, cleaned_query, rows_outfile, delimiter=delimiter or ";",
+                                          omit_header=no_header_footer, params=params, profile=profile)
+        else:
+            if stream and is_select_statement(cleaned_query):
+                if profile_log is not None:
+                    profile = new_profile(cleaned_query, "stream")
+                results = []
+                rows = self.exec_query_stream(con, cleaned_query + ";", omit_header=no_header_footer, itersize=itersize,
+                                              params=params, profile=profile)
+            else:
+                if profile_log is not None:
+                    profile = new_profile(cleaned_query, "text")
+                results = self.exec_query(con, cleaned_query + ";", omit_header=no_header_footer, params=params,
+                                          profile=profile)
+                rows = results
+            line_count = self.write_results(rows, rows_outfile=rows_outfile, delimiter=delimiter, profile=profile)
+        if no_header_footer is None:
+            self.print_footer(line_count, datetime.datetime.now() - start_time)
+        if profile is not None:
+            if explain and is_read_only_statement(cleaned_query):
+                profile["explain"] = explain_plan
+                if "Execution Time" in explain_plan:
+                    profile["server_seconds"] = explain_plan["Execution Time"] / 1000
+            self.log_profile(profile_log, profile, line_count, profile_start)
+        return results
+
+    def exec_timed_query(self, query, params=None, profile=None):
+        # Runs on a parallel worker thread with its own pooled connection
+        start_time = datetime.datetime.now()
+        with self.connection() as con:
+            results = self.exec_query(con, query, omit_header=True, params=params, profile=profile)
+        return results, datetime.datetime.now() - start_time
+
+    def run_parallel_group(self, con, group_name, cleaned_queries, parallel_workers, rows_outfile=None,
+                           delimiter=None, no_header_footer=None, profile_log: QueryProfileLog = None):
+        # cleaned_queries: [(query, params), ...] as produced by clean_query/bind_query
+        # Results of parallel statements are fully fetched by the workers, then written out in file order.
+        #  Each worker commits on its own connection, so a failing statement does not undo the others.
+        workers = min(parallel_workers, len(cleaned_queries), self.config.pool_maxconn - 1)
+        if workers < 2:
+            print("WARNING: Not enough pooled connections to run group '{}' in parallel".format(group_name))
+            results = []
+            for cleaned_query, params in cleaned_queries:
+                results = self.run_statement(con, cleaned_query, rows_outfile=rows_outfile, delimiter=delimiter,
+                                             no_header_footer=no_header_footer, params=params, profile_log=profile_log)
+            return results
+        con.commit()  # Make everything run so far visible to the worker connections
+        start_time = datetime.datetime.now()
+        results = []
+        profiles = [None] * len(cleaned_queries)
+        if profile_log is not None:
+            profiles = [new_profile(q, "parallel") for q, params in cleaned_queries]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self.exec_timed_query, q + ";", params, profile)
+                       for (q, params), profile in zip(cleaned_queries, profiles)]
+            for (cleaned_query, params), future, profile in zip(cleaned_queries, futures, profiles):
+                results, execution_time = future.result()
+                if no_header_footer is None:
+                    print(cleaned_query + ";")
+                line_count = self.write_results(results, rows_outfile=rows_outfile, delimiter=delimiter, profile=profile)
+                if no_header_footer is None:
+                    self.print_footer(line_count, execution_time)
+                if profile is not None:
+                    profile["total_seconds"] = execution_time.total_seconds() + profile["format_seconds"]
+                    if line_count > 0:
+                        profile["rows"] = line_count - 1
+                    profile_log.write(profile, config=self.config)
+        if no_header_footer is None:
+            print("Parallel group '{}' ({} statements, {} workers) execution time:".format(group_name, len(cleaned_queries), workers),
+                  datetime.datetime.now() - start_time)
+        return results
+
+    def run_cmd_line_args(self, query_filename, query_variables=None, rows_outfile=None, delimiter=None, no_header_footer=None,
+                          stream=None, itersize=DEFAULT_ITERSIZE, copy_export=None, parallel_workers=None,
+                          bind_variables=None, output_format=None, profile_log=None, explain=None):
+        # With stream or copy_export set, SELECT results are written as they are fetched and are not kept, so
+        #  the returned results will be empty for those statements. copy_export only applies when writing to
+        #  rows_outfile with a single-character delimiter.
+        # Results of read-only statements run through exec_query are served from/saved to self.cache if set.
+        # With parallel_workers set, '-- @parallel <group>' annotated statements run concurrently (see
+        #  split_statement_groups). Groups themselves still run in file order.
+        # With bind_variables set, {var} placeholders are sent as query parameters where possible (see bind_query).
+        # With a columnar output_format (parquet, arrow, npy), SELECT results go to rows_outfile in that format,
+        #  the n-th further result set to <name>.<n>.<ext>. Parallel groups and other statements still print text.
+        # With profile_log (a filename) set, a JSON line of timings, rows and bytes is appended per statement,
+        #  plus the EXPLAIN (ANALYZE, BUFFERS) plan of read-only statements if explain is set.
         qfile = query_filename
         # query_variables = None
         results = []
@@ -147,91 +761,72 @@ class DBCaller:
             with open(qfile) as qf:
                 query_text = qf.read()
         # rows_outfile = None
+        columnar_outfile = None
+        result_set_count = 0
+        if output_format in COLUMNAR_FORMATS:
+            if not rows_outfile:
+                print("ERROR: '{}' output requires a rows_outfile".format(output_format))
+                exit()
+            columnar_outfile = rows_outfile
+            rows_outfile = None
         if rows_outfile:
             rows_outfile = open(rows_outfile, "w+")
+        if profile_log:
+            profile_log = QueryProfileLog(profile_log)
         # with open(qfile) as qf:
-        con = self.get_connection()
-        # query_text = qf.read()
-        # results = []
-        query_text = self.clean_file(query_text)
-        query_statements = query_text.split(";")
-        query_statements = list(filter(None, query_statements)) # Filter out empty strings
-        if query_variables and len(query_statements) > 1:
+        if parallel_workers:
+            statement_groups = self.split_statement_groups(query_text)
+        else:
+            query_text = self.clean_file(query_text)
+            query_statements = query_text.split(";")
+            query_statements = list(filter(None, query_statements)) # Filter out empty strings
+            statement_groups = [(None, [statement]) for statement in query_statements]
+        if query_variables and len(statement_groups) > 1:
             print("WARNING: Should be careful using query variables for multi-statement SQL files")
             # exit()
-        for statement in query_statements:
-            # Add block if variables and multi-statement
-            cleaned_query = self.clean_query(statement, query_variables=query_variables)
-            if cleaned_query:
-                start_time = datetime.datetime.now()
-                results = self.exec_query(con, cleaned_query + ";", omit_header=no_header_footer)
-                if delimiter:
-                    formatted_results = self.format_results(results, delimiter=delimiter)
+        with self.connection() as con:
+            for group_name, statements in statement_groups:
+                # Add block if variables and multi-statement
+                if bind_variables:
+                    cleaned_queries = [self.bind_query(statement, query_variables=query_variables) for statement in statements]
                 else:
-                    formatted_results = self.format_results(results)
-                for r in formatted_results:
-                    if rows_outfile:
-                        rows_outfile.write("{}\n".format(r))
-                    else:
-                        print(r)
-                if no_header_footer is None:
-                    if len(results) > 0:    # Display row count unless insert, update, set, etc.
-                        print("Rows returned:", len(results) - 1)
-                    print("Execution time:", datetime.datetime.now() - start_time, "- Host:", self.config.host, "- DB:", self.config.dbname)
-        con.commit()
-        con.close()
+                    cleaned_queries = [(self.clean_query(statement, query_variables=query_variables), None) for statement in statements]
+                cleaned_queries = [cq for cq in cleaned_queries if cq[0]]
+                if group_name and len(cleaned_queries) > 1:
+                    results = self.run_parallel_group(con, group_name, cleaned_queries, parallel_workers,
+                                                      rows_outfile=rows_outfile, delimiter=delimiter,
+                                                      no_header_footer=no_header_footer, profile_log=profile_log)
+                    continue
+                for cleaned_query, params in cleaned_queries:
+                    statement_outfile = None
+                    if columnar_outfile and is_select_statement(cleaned_query):
+                        statement_outfile = self.columnar_outfile_name(columnar_outfile, result_set_count)
+                        result_set_count += 1
+                    results = self.run_statement(con, cleaned_query, rows_outfile=rows_outfile, delimiter=delimiter,
+                                                 no_header_footer=no_header_footer, stream=stream, itersize=itersize,
+                                                 copy_export=copy_export, params=params, output_format=output_format,
+                                                 columnar_outfile=statement_outfile, profile_log=profile_log,
+                                                 explain=explain)
         if rows_outfile:
             rows_outfile.close()
+        if profile_log:
+            profile_log.close()
         return results
 
 
 if __name__ == "__main__":
     args = parser.parse_args()
     qfile = args.query_filename
-    config = DBCallerConfig()
-    caller = DBCaller()
-    query_variables = None
-    if args.query_variables:
-        try:
-            query_variables = json.loads(args.query_variables)
-        except json.decoder.JSONDecodeError:
-            query_variables = args.query_variables.split(",")
     if not path.isfile(qfile):
         print("ERROR: No such query file '{}'.".format(qfile))
         exit()
-    rows_outfile = None
-    if args.rows_outfile:
-        rows_outfile = open(args.rows_outfile, "w+")
-    with open(qfile) as qf:
-        con = caller.get_connection()
-        query_text = qf.read()
-        results = []
-        query_text = caller.clean_file(query_text)
-        query_statements = query_text.split(";")
-        query_statements = list(filter(None, query_statements)) # Filter out empty strings
-        if query_variables and len(query_statements) > 1:
-            print("WARNING: Should be careful using query variables for multi-statement SQL files")
-            # exit()
-        for statement in query_statements:
-            # Add block if variables and multi-statement
-            cleaned_query = caller.clean_query(statement, query_variables=query_variables)
-            if cleaned_query:
-                start_time = datetime.datetime.now()
-                results = caller.exec_query(con, cleaned_query + ";", omit_header=args.no_header_footer)
-                if args.delimiter:
-                    formatted_results = caller.format_results(results, delimiter=args.delimiter)
-                else:
-                    formatted_results = caller.format_results(results)
-                for r in formatted_results:
-                    if rows_outfile:
-                        rows_outfile.write("{}\n".format(r))
-                    else:
-                        print(r)
-                if args.no_header_footer is None:
-                    if len(results) > 0:    # Display row count unless insert, update, set, etc.
-                        print("Rows returned:", len(results) - 1)
-                    print("Execution time:", datetime.datetime.now() - start_time, "- Host:", caller.config.host, "- DB:", caller.config.dbname)
-        con.commit()
-        con.close()
-    if rows_outfile:
-        rows_outfile.close()
\ No newline at end of file
+    cache = None
+    if args.cache_dir:
+        cache = QueryResultCache(args.cache_dir, ttl=args.cache_ttl)
+    with DBCaller(cache=cache) as caller:
+        caller.run_cmd_line_args(qfile, query_variables=args.query_variables, rows_outfile=args.rows_outfile,
+                                 delimiter=args.delimiter, no_header_footer=args.no_header_footer,
+                                 stream=args.stream, itersize=args.itersize, copy_export=args.copy_export,
+                                 parallel_workers=args.parallel_workers, bind_variables=args.bind_variables,
+                                 output_format=args.output_format, profile_log=args.profile_log,
+                                 explain=args.explain)
@@ -1,5 +1,7 @@
 import csv
-from typing import List, Dict
+import sys
+from array import array
+from typing import List, Dict, Tuple
 import logging
 
 logger = logging.getLogger(__name__)
@@ -138,6 +140,8 @@ class RefProtPantherMapping:
 
 
 class DatEntry:
+    __slots__ = ()
+
     def __init__(self, *args):
         pass
 
@@ -200,7 +204,52 @@ class GeneDatFile(DatFile):
                 return entry
 
 
+class TypeCodes:
+    # Small int codes for a column's few distinct values (node/event types), each value kept as one shared string
+    def __init__(self, names: List[str]):
+        self.names = []
+        self.codes = {}
+        for name in names:
+            self.code(name)
+
+    def code(self, name):
+        code = self.codes.get(name)
+        if code is None:
+            code = len(self.names)
+            if isinstance(name, str):
+                name = sys.intern(name)
+            self.names.append(name)
+            self.codes[name] = code
+        return code
+
+    def intern(self, name):
+        return self.names[self.code(name)]
+
+
+NODE_TYPE_CODES = TypeCodes(["ROOT", "INTERNAL", "LEAF"])
+EVENT_TYPE_CODES = TypeCodes(["", "SPECIATION", "DUPLICATION", "HORIZONTAL_TRANSFER"])
+
+
+class StringColumn:
+    # Strings stored end to end in one buffer instead of as one object each
+    def __init__(self):
+        self.text = bytearray()
+        self.offsets = array("q", [0])
+
+    def append(self, value: str):
+        self.text += value.encode()
+        self.offsets.append(len(self.text))
+
+    def __getitem__(self, i):
+        return self.text[self.offsets[i]:self.offsets[i + 1]].decode()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
 class NodeDatEntry(DatEntry):
+    __slots__ = ("an_id", "ptn", "node_type", "event_type", "branch_length")
+
     def __init__(self, an_id: str, ptn: str, node_type: str, event_type: str, branch_length: float):
         super().__init__(self, an_id, ptn, node_type, event_type, branch_length)
         self.an_id = an_id
@@ -211,7 +260,7 @@ class NodeDatEntry(DatEntry):
 
     @classmethod
     def parse_row(cls, row: List[str]):
-        return cls(*row[0:4], float(row[4]))
+        return cls(row[0], row[1], NODE_TYPE_CODES.intern(row[2]), EVENT_TYPE_CODES.intern(row[3]), float(row[4]))
 
     def __str__(self):
         event_type = self.event_type
@@ -222,24 +271,149 @@ class NodeDatEntry(DatEntry):
 
 
 class NodeDatFile(DatFile):
+    """
+    node.dat entries, stored column-wise to keep the full library's node.dat small in memory: family prefixes as
+    codes into family_names, AN and PTN IDs in StringColumns, node and event types as TypeCodes codes and branch
+    lengths in a float array. Iterating creates NodeDatEntry objects on the fly. Use stream() to scan node.dat
+    without keeping entries, or index() to read single families from it.
+    """
     ENTRY_TYPE = NodeDatEntry
 
     def __init__(self, filename: str):
         super().__init__(filename)
-        self.ptn_to_an: Dict[str, str] = {}
-        self.an_to_ptn: Dict[str, str] = {}
+        # Set by index(): family -> (start, end) byte ranges of its lines, in file order
+        self.family_offsets: Dict[str, List[Tuple[int, int]]] = None
+        self.line_count = 0
+        self._ptn_to_an: Dict[str, str] = None
+        self._an_to_ptn: Dict[str, str] = None
+
+    @property
+    def entries(self) -> List[NodeDatEntry]:
+        return list(self)
+
+    @entries.setter
+    def entries(self, entries: List[NodeDatEntry]):
+        self.family_names: List[str] = []
+        self.family_codes: Dict[str, int] = {}
+        self.family_ids = array("i")
+        self.an_ids = StringColumn()  # AN IDs without the family prefix
+        self.ptns = StringColumn()
+        self.node_type_codes = bytearray()
+        self.event_type_codes = bytearray()
+        self.branch_lengths = array("d")
+        for entry in entries:
+            self.add_entry(entry)
+
+    def add_entry(self, entry: NodeDatEntry):
+        family, sep, an_id = entry.an_id.partition(":")
+        if not sep:
+            family, an_id = "", family
+        family_id = self.family_codes.get(family)
+        if family_id is None:
+            family_id = self.family_codes[family] = len(self.family_names)
+            self.family_names.append(sys.intern(family))
+        self.family_ids.append(family_id)
+        self.an_ids.append(an_id)
+        self.ptns.append(entry.ptn)
+        self.node_type_codes.append(NODE_TYPE_CODES.code(entry.node_type))
+        self.event_type_codes.append(EVENT_TYPE_CODES.code(entry.event_type))
+        self.branch_lengths.append(entry.branch_length)
+        self._ptn_to_an = self._an_to_ptn = None
+
+    def full_an_id(self, i):
+        family = self.family_names[self.family_ids[i]]
+        if family:
+            return family + ":" + self.an_ids[i]
+        return self.an_ids[i]
+
+    def entry(self, i):
+        return self.ENTRY_TYPE(self.full_an_id(i), self.ptns[i], NODE_TYPE_CODES.names[self.node_type_codes[i]],
+                               EVENT_TYPE_CODES.names[self.event_type_codes[i]], self.branch_lengths[i])
+
+    @property
+    def ptn_to_an(self) -> Dict[str, str]:
+        # Built on first use
+        if self._ptn_to_an is None:
+            self._ptn_to_an = {self.ptns[i]: self.full_an_id(i) for i in range(len(self.ptns))}
+        return self._ptn_to_an
+
+    @property
+    def an_to_ptn(self) -> Dict[str, str]:
+        if self._an_to_ptn is None:
+            self._an_to_ptn = {self.full_an_id(i): self.ptns[i] for i in range(len(self.ptns))}
+        return self._an_to_ptn
+
+    @classmethod
+    def stream(cls, filename: str):
+        # Entries one at a time, for callers that only scan node.dat
+        with open(filename) as f:
+            reader = csv.reader(f, delimiter="\t")
+            for r in reader:
+                entry = cls.ENTRY_TYPE.parse_row(r)
+                if entry:
+                    yield entry
 
     @classmethod
     def parse(cls, filename: str):
-        node_dat_file: cls = super().parse(filename)
-        entry: cls.ENTRY_TYPE
-        for entry in node_dat_file:
-            an = entry.an_id
-            ptn = entry.ptn
-            node_dat_file.ptn_to_an[ptn] = an
-            node_dat_file.an_to_ptn[an] = ptn
+        node_dat_file = cls(filename)
+        for entry in cls.stream(filename):
+            node_dat_file.add_entry(entry)
+        return node_dat_file
+
+    @classmethod
+    def index(cls, filename: str):
+        """
+        Scan node.dat once for where each family's lines are, without parsing entries. Entries are then parsed
+        per family by family_entries, so a single family doesn't cost a parse of the whole file.
+        """
+        node_dat_file = cls(filename)
+        node_dat_file.family_offsets = {}
+        family = None
+        start = offset = 0
+        with open(filename, "rb") as f:
+            for line in f:
+                node_dat_file.line_count += 1
+                line_family = line.split(b":", 1)[0].decode()
+                if line_family != family:
+                    if family is not None:
+                        node_dat_file.family_offsets.setdefault(family, []).append((start, offset))
+                    family = line_family
+                    start = offset
+                offset += len(line)
+        if family is not None:
+            node_dat_file.family_offsets.setdefault(family, []).append((start, offset))
         return node_dat_file
 
+    def family_entries(self, family: str):
+        if self.family_offsets is None:
+            family_id = self.family_codes.get(family)
+            return [self.entry(i) for i, f in enumerate(self.family_ids) if f == family_id]
+        entries = []
+        with open(self.filename, "rb") as f:
+            for start, end in self.family_offsets.get(family, []):
+                f.seek(start)
+                reader = csv.reader(f.read(end - start).decode().splitlines(), delimiter="\t")
+                for r in reader:
+                    entry = self.ENTRY_TYPE.parse_row(r)
+                    if entry:
+                        entries.append(entry)
+        return entries
+
+    def families(self):
+        if self.family_offsets is None:
+            return [family for family in self.family_names if family]
+        return list(self.family_offsets)
+
+    def __iter__(self):
+        if self.family_offsets is None:
+            return (self.entry(i) for i in range(len(self.family_ids)))
+        return (entry for family in self.families() for entry in self.family_entries(family))
+
+    def __len__(self):
+        if self.family_offsets is None:
+            return len(self.family_ids)
+        return self.line_count
+
 
 class OrganismDatEntry(DatEntry):
     pass
@@ -0,0 +1,158 @@
+import re
+from array import array
+
+# Same tokens as Bio.Phylo's Newick parser, so trees parse to the same names, branch lengths and comments
+NHX_TOKENS = re.compile(r"""
+    (?P<open>\()
+  | (?P<close>\))
+  | (?P<label>[^\s()\[\]':;,]+)
+  | (?P<length>:\ ?[+-]?[0-9]*\.?[0-9]+(?:[eE][+-]?[0-9]+)?)
+  | (?P<comma>,)
+  | (?P<comment>\[(?:\\.|[^\]])*\])
+  | (?P<quoted>'(?:\\.|[^'])*')
+  | (?P<semicolon>;)
+""", re.VERBOSE)
+
+# Labels Bio.Phylo's Newick writer leaves unquoted
+UNQUOTED_LABEL = re.compile(r"[^\s()\[\]':;,]+")
+
+
+class NhxParseError(Exception):
+    pass
+
+
+def parse_confidence(text):
+    # As Bio.Phylo does for numeric internal node labels
+    if text.isdigit():
+        return int(text)
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def format_label(label):
+    # Quoted as Bio.Phylo's Newick writer does
+    if not label:
+        return ""
+    unquoted = UNQUOTED_LABEL.match(label)
+    if not unquoted or unquoted.end() < len(label):
+        return "'{}'".format(label.replace("'", "''"))
+    return label
+
+
+def format_node_info(branch_length, confidence=None, comment=None, terminal=False):
+    # What follows a node's label in Bio.Phylo's default Newick output: internal node confidence, ':' and branch
+    #  length (0 if none), then the [comment]
+    if terminal or confidence is None:
+        info = ":%1.8g" % (branch_length or 0.0)
+    else:
+        info = "%1.2f:%1.8g" % (confidence, branch_length or 0.0)
+    if comment:
+        info += "[{}]".format(comment.replace("[", "\\[").replace("]", "\\]"))
+    return info
+
+
+class NhxTree:
+    """
+    One parsed Newick/NHX tree as flat per-node lists, nodes numbered in order of appearance. parent[i] is -1 for
+    the root. label is the Newick node label (None if unlabeled) and comment the text inside the node's [...],
+    if any. Numeric internal node labels are moved to confidence, as Bio.Phylo does.
+    """
+
+    def __init__(self):
+        self.parent = array("i")
+        self.children = []
+        self.label = []
+        self.branch_length = []
+        self.comment = []
+        self.confidence = []
+        self.root = 0
+
+    def add_node(self, parent=-1):
+        node = len(self.parent)
+        self.parent.append(parent)
+        self.children.append([])
+        self.label.append(None)
+        self.branch_length.append(None)
+        self.comment.append(None)
+        self.confidence.append(None)
+        return node
+
+    def close_node(self, node):
+        # Node is complete: attach it to its parent and return the parent
+        label = self.label[node]
+        if label and self.children[node] and self.confidence[node] is None:
+            self.confidence[node] = parse_confidence(label)
+            if self.confidence[node] is not None:
+                self.label[node] = None
+        parent = self.parent[node]
+        if parent >= 0:
+            self.children[parent].append(node)
+        return parent
+
+    def preorder(self):
+        nodes = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(reversed(self.children[node]))
+        return nodes
+
+    def __len__(self):
+        return len(self.parent)
+
+
+def parse_nhx(text):
+    """
+    Parses the first tree in text, up to its ';'
+    :param text: Newick tree string, NHX attributes in [&&NHX:...] comments
+    :return: NhxTree
+    """
+    tree = NhxTree()
+    add_node = tree.add_node
+    label = tree.label
+    current = add_node()
+    open_count = close_count = 0
+    tokens = NHX_TOKENS.finditer(text.strip())
+    for match in tokens:
+        kind = match.lastgroup
+        if kind == "label":
+            label[current] = match.group()
+        elif kind == "length":
+            tree.branch_length[current] = float(match.group()[1:])
+        elif kind == "comment":
+            tree.comment[current] = match.group()[1:-1]
+        elif kind == "open":
+            current = add_node(current)
+            open_count += 1
+        elif kind == "comma":
+            if current == tree.root:
+                # Top-level siblings without enclosing parentheses get a new, unlabeled root
+                tree.root = add_node()
+                tree.parent[current] = tree.root
+            current = add_node(tree.close_node(current))
+        elif kind == "close":
+            current = tree.close_node(current)
+            if current < 0:
+                raise NhxParseError("Parenthesis mismatch.")
+            close_count += 1
+        elif kind == "quoted":
+            token = match.group()
+            if not label[current]:
+                label[current] = token[1:-1]
+            else:
+                label[current] += token[:-1]
+        elif kind == "semicolon":
+            break
+    if open_count != close_count:
+        raise NhxParseError("Mismatch, {} open vs {} close parentheses.".format(open_count, close_count))
+    next_token = next(tokens, None)
+    if next_token is not None:
+        raise NhxParseError("Text after semicolon in Newick tree: {}".format(next_token.group()))
+    tree.close_node(current)
+    if current != tree.root:
+        tree.close_node(tree.root)
+    return tree
+
@@ -1,29 +1,32 @@
-import copy
 import csv
-import networkx
+from array import array
 from networkx import MultiDiGraph
 from typing import List, Dict
-from Bio import Phylo
-from Bio.Phylo import Newick
 from io import StringIO
 from pthr_db_caller.models.panther import NodeDatFile
+from pthr_db_caller.nhx import NhxTree, parse_nhx, format_label, format_node_info
+from pthr_db_caller.tree_index import TreeIndex
 
 
 # Unfortunately, this only uses AN# node IDs instead of PTNs due to parsing from tree files.
-# If we parsed the enormous node.dat we could add a PTN option.
+# PTNs are added from node.dat when a node_file is passed to parse(); use NodeDatFile.index for the full node.dat.
 
 class PantherTreePhylo:
 
-    def __init__(self, tree_file):
-        # Load graph from tree file
-        with open(tree_file) as tf:
-            tree_line = tf.readline()
-            tree_string = StringIO(tree_line)
-            # tree_phylo = next(PantherNewickIOParser(tree_string).parse())
-            tree_phylo = next(Phylo.parse(tree_string, "newick"))
-            # Leaves parse clean due to not having species name in 'S:'
+    def __init__(self, tree_file=None, tree=None):
+        # Bio.Phylo is only imported when a Phylo tree is actually needed (see PantherTreeGraph.phylo)
+        from Bio import Phylo
+        from Bio.Phylo import Newick
+        if tree is None:
+            # Load graph from tree file
+            with open(tree_file) as tf:
+                tree_line = tf.readline()
+                tree_string = StringIO(tree_line)
+                # tree_phylo = next(PantherNewickIOParser(tree_string).parse())
+                tree = next(Phylo.parse(tree_string, "newick"))
+                # Leaves parse clean due to not having species name in 'S:'
 
-        self.tree: Newick.Tree = tree_phylo
+        self.tree: Newick.Tree = tree
 
 
 def extract_clade_name(clade_comment):
@@ -60,7 +63,31 @@ class PantherTreeGraph:
         self.ptn_to_an: Dict = {}
         self.an_to_ptn: Dict = {}
         self.an_to_sf: Dict = {}
-        self.phylo: PantherTreePhylo = None
+        self._phylo: PantherTreePhylo = None
+        self._index: TreeIndex = None
+        # Newick branch lengths, comments and confidences by node, for building the Phylo tree on demand
+        self.branch_lengths: Dict = {}
+        self.comments: Dict = {}
+        self.confidences: Dict = {}
+
+    @property
+    def phylo(self) -> PantherTreePhylo:
+        # Trees parsed by parse() only get a Bio.Phylo tree when something (write, remove_node) asks for it
+        if self._phylo is None and len(self.graph) > 0 and self.branch_lengths:
+            self._phylo = self.build_phylo()
+        return self._phylo
+
+    @phylo.setter
+    def phylo(self, phylo: PantherTreePhylo):
+        self._phylo = phylo
+
+    @property
+    def index(self) -> TreeIndex:
+        # Topology arrays for root/parent/children/leaf/ancestor queries. Built on first use after parsing and
+        #  rebuilt after nodes are removed.
+        if self._index is None or len(self._index) != len(self.graph):
+            self._index = TreeIndex.from_graph(self.graph)
+        return self._index
 
     # Recursive method to fill graph from Phylo clade, parsing out node accession and species name (if present)
     def add_children(self, parent_clade):
@@ -94,16 +121,23 @@ class PantherTreeGraph:
     def extract_leaf_ids(self, tree_file):
         with open(tree_file) as tf:
             tf.readline()  # ignore first line, it's parsed already
-            for l in tf.readlines():
-                an_id, long_id = l.split(":", maxsplit=1)
-                long_id = long_id.rstrip().rstrip(";")
-                if an_id in self.graph:
-                    self.graph.nodes[an_id]["long_id"] = long_id
+            self.add_leaf_ids(tf)
+
+    def add_leaf_ids(self, leaf_lines):
+        # Lines like "AN5:SCHPO|PomBase=SPAC25B8.12c|UniProtKB=Q9UTA6;"
+        nodes = self.graph.nodes
+        for l in leaf_lines:
+            an_id, long_id = l.split(":", maxsplit=1)
+            long_id = long_id.rstrip().rstrip(";")
+            if an_id in nodes:
+                nodes[an_id]["long_id"] = long_id
 
     def extract_node_properties(self, node_dat_file: NodeDatFile):
-        for entry in node_dat_file:
-            family_name, an_id = entry.an_id.split(":", maxsplit=1)
-            if self.name == family_name and an_id in self.graph:
+        # Only this family's entries, read straight from their place in the file if node_dat_file is indexed
+        #  (NodeDatFile.index)
+        for entry in node_dat_file.family_entries(self.name):
+            an_id = entry.an_id.split(":", maxsplit=1)[1]
+            if an_id in self.graph:
                 self.ptn_to_an[entry.ptn] = an_id
                 self.an_to_ptn[an_id] = entry.ptn
                 self.graph.nodes[an_id]["ptn"] = entry.ptn
@@ -112,34 +146,50 @@ class PantherTreeGraph:
                 # branch_length?
 
     def get_sf_for_an(self, an_id):
+        # SF of the nearest node, an_id itself included, found in an_to_sf walking up the tree. Nodes passed on the
+        #  way are cached with it.
         if an_id in self.an_to_sf:
             return self.an_to_sf[an_id]
-        else:
-            parents = self.parents(an_id.split(":", maxsplit=1)[1])
-            if parents:
-                parent_an_id = "{}:{}".format(self.name, parents[0])  # Assuming always only one parent
-                self.an_to_sf[parent_an_id] = self.get_sf_for_an(parent_an_id)
-                return self.an_to_sf[parent_an_id]
+        index = self.index
+        path = [an_id]
+        sf = None
+        for ancestor_id in index.ancestor_ids(index.node_id(an_id.split(":", maxsplit=1)[1])):
+            ancestor_an_id = "{}:{}".format(self.name, index.names[ancestor_id])
+            if ancestor_an_id in self.an_to_sf:
+                sf = self.an_to_sf[ancestor_an_id]
+                break
+            path.append(ancestor_an_id)
+        for path_an_id in path:
+            self.an_to_sf[path_an_id] = sf
+        return sf
 
     def extract_sf_assignments(self, an_to_sf_seed: Dict):
+        # Every node gets its own seed SF, else its nearest seeded ancestor's, else None. One preorder pass, parents
+        #  before children. an_to_sf_seed (full "family:AN" IDs) is filled in and kept as self.an_to_sf.
         self.an_to_sf = an_to_sf_seed
-
-        for n in self.graph.nodes():
-            full_an_id = "{}:{}".format(self.name, n)
-            if full_an_id not in self.an_to_sf:
-                self.an_to_sf[full_an_id] = self.get_sf_for_an(full_an_id)
+        index = self.index
+        node_sfs = [None] * len(index)
+        for i in index.preorder:
+            full_an_id = "{}:{}".format(self.name, index.names[i])
+            if full_an_id in self.an_to_sf:
+                node_sfs[i] = self.an_to_sf[full_an_id]
+            else:
+                parent_id = index.parent[i]
+                if parent_id >= 0:
+                    node_sfs[i] = node_sfs[parent_id]
+                self.an_to_sf[full_an_id] = node_sfs[i]
 
     @staticmethod
     def parse(tree_file: str, tree_name: str = None, node_file: NodeDatFile = None):
         pthr_tree_graph = PantherTreeGraph(tree_name)
 
-        # Parse Newick line
-        phylo = PantherTreePhylo(tree_file)
-        pthr_tree_graph.init_from_phylo(phylo)
-        # Fill in long IDs on leaf nodes
-        pthr_tree_graph.extract_leaf_ids(tree_file)
+        with open(tree_file) as tf:
+            # Parse Newick line
+            pthr_tree_graph.init_from_nhx(parse_nhx(tf.readline()))
+            # Fill in long IDs on leaf nodes
+            pthr_tree_graph.add_leaf_ids(tf)
         # Fill in PTNs if node_file specified
-        if node_file:
+        if node_file is not None:
             pthr_tree_graph.extract_node_properties(node_file)
 
         return pthr_tree_graph
@@ -149,52 +199,223 @@ class PantherTreeGraph:
         # Fill networkx graph from Phylo obj
         self.add_children(phylo.tree.clade)
 
+    def init_from_nhx(self, nhx_tree: NhxTree):
+        # Fills the graph as add_children would from the equivalent Phylo tree: nodes in preorder, named by label,
+        #  else by ID=, else by S= (see add_node_from_clade)
+        preorder = nhx_tree.preorder()
+        names = [None] * len(nhx_tree)
+        nodes = []
+        edges = []
+        for i in preorder:
+            comment = nhx_tree.comment[i]
+            species, an_id = extract_clade_name(comment) if comment else ("", "")
+            name = nhx_tree.label[i]
+            if name is None:
+                name = an_id
+            if name == "":
+                name = species
+            names[i] = name
+            nodes.append((name, {"species": species}) if species else name)
+            parent = nhx_tree.parent[i]
+            if parent >= 0:
+                edges.append((names[parent], name))
+            self.branch_lengths[name] = nhx_tree.branch_length[i]
+            self.comments[name] = comment
+            if nhx_tree.confidence[i] is not None:
+                self.confidences[name] = nhx_tree.confidence[i]
+        self.graph.add_nodes_from(nodes)
+        self.graph.add_edges_from(edges)
+        if len(self.graph) < len(nhx_tree):
+            # Repeated node names (e.g. a taxon name on several species tree nodes) are merged in the graph, so
+            #  the Phylo tree can't be rebuilt from it later
+            self.phylo = self.build_phylo(nhx_tree, names)
+        else:
+            # Graph nodes are in preorder, so the index can be built straight from the parsed tree
+            position = [0] * len(nhx_tree)
+            for p, i in enumerate(preorder):
+                position[i] = p
+            self._index = TreeIndex([names[i] for i in preorder],
+                                    [[position[c] for c in nhx_tree.children[i]] for i in preorder])
+
+    def build_phylo(self, nhx_tree: NhxTree = None, names: List = None):
+        # Phylo tree of the graph as it is now, pruning included, or of a parsed tree
+        from Bio.Phylo import Newick
+        if nhx_tree is not None:
+            nodes = nhx_tree.preorder()
+            clades = [None] * len(nhx_tree)
+            for i in reversed(nodes):
+                clades[i] = Newick.Clade(branch_length=nhx_tree.branch_length[i], name=names[i],
+                                         clades=[clades[c] for c in nhx_tree.children[i]],
+                                         confidence=nhx_tree.confidence[i], comment=nhx_tree.comment[i])
+            root = clades[nhx_tree.root]
+        else:
+            index = self.index
+            clades = [None] * len(index)
+            for i in index.postorder:
+                name = index.names[i]
+                clades[i] = Newick.Clade(branch_length=self.branch_lengths.get(name), name=name,
+                                         clades=[clades[c] for c in index.child_ids[index.child_offsets[i]:index.child_offsets[i + 1]]],
+                                         confidence=self.confidences.get(name), comment=self.comments.get(name))
+            root = clades[index.roots[0]]
+        return PantherTreePhylo(tree=Newick.Tree(root=root, rooted=False))
+
     def write(self, outpath):
-        transformed_tree = copy.deepcopy(self.phylo.tree)
-        self.traverse(transformed_tree.clade)
-        Phylo.write(transformed_tree, outpath, 'newick')
+        # Newick output of the tree with traverse's renaming, written straight from the tree index (or the Phylo
+        #  tree, if there is one) without copying the tree. Same text as Bio.Phylo's Newick writer.
+        if self._phylo is None and len(self.graph) > 0 and self.branch_lengths:
+            index = self.index
+            root = index.roots[0]
+
+            def node_fields(i):
+                name = index.names[i]
+                children = index.child_ids[index.child_offsets[i]:index.child_offsets[i + 1]]
+                return (name, self.comments.get(name), self.branch_lengths.get(name), self.confidences.get(name),
+                        children)
+        else:
+            root = self.phylo.tree.root
+
+            def node_fields(clade):
+                return clade.name, clade.comment, clade.branch_length, clade.confidence, clade.clades
+
+        parts = []
+        stack = [(root, None)]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                parts.append(item)
+                continue
+            node, parent_species = item
+            name, comment, branch_length, confidence, children = node_fields(node)
+            name, comment, species = self.newick_node(name, comment, parent_species)
+            node_text = format_label(name) + format_node_info(branch_length, confidence, comment,
+                                                              terminal=not children)
+            if not children:
+                parts.append(node_text)
+                continue
+            parts.append("(")
+            stack.append(")" + node_text)
+            for k, child in enumerate(reversed(children)):
+                if k > 0:
+                    stack.append(",")
+                stack.append((child, species))
+        parts.append(";\n")
+        if hasattr(outpath, "write"):
+            outpath.write("".join(parts))
+        else:
+            with open(outpath, "w") as out_f:
+                out_f.write("".join(parts))
 
-    def traverse(self, c, parent_species=None):
-        species, nid = extract_clade_name(c.comment)
+    def newick_node(self, name, comment, parent_species=None):
+        # Output name and comment of a node, plus the species its leaf children fall back on
+        species, nid = extract_clade_name(comment)
         if nid == "":
             # Likely a leaf node
-            cn = self.node(c.name)
+            cn = self.node(name)
             long_id = cn.get("long_id")
             species = long_id.split("|")[0]
             nid = long_id.split("|")[2].split("=")[1]
             if species == "":
                 species = parent_species
-            c.name = self.newick_name_fmt(species, nid)
+            name = self.newick_name_fmt(species, nid)
         else:
-            c.name = "1"
+            name = "1"
         # Transform event type values ("0>1" -> "S", "1>0" -> "D")
-        if c.comment:
+        if comment:
             # &&NHX:Ev=0>1:S=Amoebozoa:ID=AN7
             new_comment_elements = ["&&NHX"]
-            if "Ev=0>1" in c.comment:
+            if "Ev=0>1" in comment:
                 new_comment_elements.append("Ev=S")  # speciation
-            elif "Ev=1>0" in c.comment:
+            elif "Ev=1>0" in comment:
                 new_comment_elements.append("Ev=D")  # duplication
-            elif "Ev=0>0" in c.comment:
+            elif "Ev=0>0" in comment:
                 new_comment_elements.append("Ev=D")  # horizontal transfer, but pretend like it's duplication
-            c.comment = ":".join(new_comment_elements)
+            comment = ":".join(new_comment_elements)
+        return name, comment, species
+
+    def traverse(self, c, parent_species=None):
+        # Renames a Phylo tree's clades in place as write does
+        c.name, c.comment, species = self.newick_node(c.name, c.comment, parent_species)
         for child_clade in c.clades:
             self.traverse(child_clade, parent_species=species)
 
     def prune_species(self, taxon_list: List):
         """
-        Process:
-        1. Find all terminal leaf nodes having taxon (OS code format) NOT in taxon_list. Delete these.
-        2. Starting from the terminal nodes, traverse up, deleting all parent nodes until reaching a node with >1 children.
-        3. Stop traversing that path and move on to traversing up the next terminal node
+        Process, in one postorder pass over the tree index:
+        1. Keep leaf nodes having taxon (OS code format) in taxon_list, and every ancestor of a kept leaf. Delete
+           all other nodes.
+        2. Collapse kept nodes left with a single child out of several (as Bio.Phylo's prune does): the child takes
+           the node's place, adding the node's branch length to its own. A collapsed root moves down to its child.
+        3. Rebuild the graph and Newick tree once from the result
         :param taxon_list: The List of OS codes ('5-letter' OSCODES. Ex: HUMAN, MOUSE, SCHPO) that will remain in tree
         after pruning list non-members
         """
-        for leaf in self.leaves():
-            long_id = self.node(leaf)["long_id"]
-            species = long_id.split("|")[0]
-            if species not in taxon_list:
-                self.prune_up(leaf)
+        taxa = set(taxon_list)
+        index = self.index
+        keep = bytearray(len(index))
+        for i in index.postorder:
+            if index.leaf[i]:
+                long_id = self.graph.nodes[index.names[i]]["long_id"]
+                keep[i] = long_id.split("|")[0] in taxa
+            if keep[i] and index.parent[i] >= 0:
+                keep[index.parent[i]] = 1
+        if all(keep):
+            return
+        if not any(keep):
+            self.graph = MultiDiGraph()
+            self._index = None
+            return
+
+        # Each kept node is replaced by itself or, if collapsed, by whatever replaces its only kept child
+        replacement = array("i", range(len(index)))
+        kept_children = {}
+        for i in index.postorder:
+            if not keep[i]:
+                continue
+            children = index.child_ids[index.child_offsets[i]:index.child_offsets[i + 1]]
+            kept = [replacement[c] for c in children if keep[c]]
+            if len(kept) == 1 and len(children) > 1:
+                replacement[i] = kept[0]
+                child_name = index.names[kept[0]]
+                if self.branch_lengths.get(child_name) is not None:
+                    self.branch_lengths[child_name] += self.branch_lengths.get(index.names[i]) or 0.0
+            else:
+                kept_children[i] = kept
+
+        pruned_graph = MultiDiGraph()
+        for i, name in enumerate(index.names):
+            if i in kept_children:
+                pruned_graph.add_node(name, **self.graph.nodes[name])
+        for i, children in kept_children.items():
+            for c in children:
+                pruned_graph.add_edge(index.names[i], index.names[c])
+        self.graph = pruned_graph
+        self._index = None
+        if self._phylo is not None:
+            self.prune_phylo({index.names[i] for i in range(len(index)) if keep[i]})
+
+    def prune_phylo(self, kept_names):
+        # Same pruning on the Phylo tree, following Bio.Phylo's prune collapsing: when a clade is left with one
+        #  child clade, that child's branch length (if set) gets the clade's branch length added to it
+        replacement = {}
+        clades = [self.phylo.tree.root]
+        postorder = []
+        while clades:
+            clade = clades.pop()
+            postorder.append(clade)
+            clades.extend(clade.clades)
+        for clade in reversed(postorder):
+            if clade.name not in kept_names:
+                continue
+            kept = [replacement[id(c)] for c in clade.clades if c.name in kept_names]
+            if len(kept) == 1 and len(clade.clades) > 1:
+                child = kept[0]
+                if child.branch_length is not None:
+                    child.branch_length += clade.branch_length or 0.0
+                replacement[id(clade)] = child
+            else:
+                clade.clades = kept
+                replacement[id(clade)] = clade
+        self.phylo.tree.root = replacement[id(self.phylo.tree.root)]
 
     @staticmethod
     def newick_name_fmt(species, nid):
@@ -208,38 +429,44 @@ class PantherTreeGraph:
         return self.graph.nodes.get(node)
 
     def root(self):
-        for n in self.graph.nodes():
-            # This criteria is asking to be abused
-            if self.parents(n) == []:
-                return n
+        # First node (in graph order) without a parent
+        return self.index.root()
 
     def ancestors(self, node, reflexive=False):
-        nodes = list(networkx.ancestors(self.graph, node))
+        # Nearest first
+        nodes = self.index.ancestors_of(node)
         if reflexive:
             nodes.append(node)
         return nodes
 
     def descendants(self, node, reflexive=False):
-        nodes = list(networkx.descendants(self.graph, node))
+        # In preorder
+        nodes = self.index.descendants_of(node)
         if reflexive:
             nodes.append(node)
         return nodes
 
+    def is_ancestor(self, ancestor_node, descendant_node):
+        return self.index.is_ancestor(ancestor_node, descendant_node)
+
+    def is_leaf(self, node):
+        return self.index.is_leaf(node)
+
     def parents(self, node):
-        return list(self.graph.predecessors(node))
+        parent = self.index.parent_of(node)
+        if parent is None:
+            return []
+        return [parent]
 
     def children(self, node):
-        return list(self.graph.successors(node))
+        return self.index.children_of(node)
 
     def leaves(self, node=None):
-        leaves = []
         if node is None:
             node = self.root()
-        for n in self.descendants(node):
-            if self.children(n):
-                continue  # Has children so not a leaf
-            leaves.append(n)
-        return leaves
+            if node is None:
+                return []
+        return self.index.leaves_of(node)
 
     def subgraph(self, nodes: List):
         return self.graph.subgraph(nodes).copy()
@@ -252,9 +479,12 @@ class PantherTreeGraph:
         return pthr_tree_graph
 
     def nodes_between(self, ancestor_node, descendant_node):
-        descendants_of_anc = self.descendants(ancestor_node)
-        ancestors_of_desc = self.ancestors(descendant_node)
-        return list(set(descendants_of_anc) & set(ancestors_of_desc))
+        # Path from descendant_node up to ancestor_node, both excluded
+        return self.index.nodes_between(ancestor_node, descendant_node)
+
+    def common_ancestor(self, node_a, node_b):
+        # Lowest common ancestor, which is one of the nodes if it's an ancestor of the other
+        return self.index.lca(node_a, node_b)
 
     def prune_up(self, node):
         """
@@ -262,22 +492,26 @@ class PantherTreeGraph:
         :param node:
         :return:
         """
-        parents = self.parents(node)
+        # Straight from the graph, which changes under the index as nodes are removed
+        parents = list(self.graph.predecessors(node))
         if len(parents) > 1:
             print("WARNING: Tree node {} has multiple parents:".format(node), parents)
-        if len(self.children(node)) < 2:
+        if len(list(self.graph.successors(node))) < 2:
             if parents:
                 self.prune_up(parents[0])
             self.remove_node(node)
 
     def remove_node(self, node):
-        # Here, we remove from both graph and phylo
+        # Here, we remove from both graph and phylo. The Phylo tree has to exist before the graph changes, as
+        #  it's built from the graph on first use.
+        phylo = self.phylo
         self.graph.remove_node(node)
+        self._index = None
         if len(self) == 0:
             # Nothing left to "prune" (.prune() below will break) so we are done here
             return
-        if self.phylo.tree.find_any(node):
-            self.phylo.tree.prune(node)
+        if phylo.tree.find_any(node):
+            phylo.tree.prune(node)
 
     def __len__(self):
         return len(self.graph)
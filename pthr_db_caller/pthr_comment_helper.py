@@ -1,4 +1,16 @@
+import asyncio
+from typing import Dict, List
+from psycopg2 import sql
+from psycopg2.extras import execute_values
 from pthr_db_caller.db_caller import DBCaller
+from pthr_db_caller.async_db_caller import AsyncDBCaller, DEFAULT_CONCURRENCY
+
+COMMENTS_QUERY = """
+        select cm.* from panther_upl.{comments_tablename} cm
+        join panther_upl.classification c on c.classification_id = cm.classification_id
+        where c.classification_version_sid = {classification_version_sid}
+        and c.accession = '{family_id}';
+        """
 
 
 class Comment:
@@ -78,14 +90,20 @@ class PthrCommentHelper:
         self.comments_tablename = comments_tablename
         self.classification_version_sid = classification_version_sid
 
+    def query_variables(self, **kwargs):
+        query_variables = {"comments_tablename": self.comments_tablename,
+                           "classification_version_sid": self.classification_version_sid}
+        query_variables.update(kwargs)
+        return query_variables
+
     def get_family_classification_id(self, family_id):
         query = """
         select classification_id from panther_upl.classification
         where classification_version_sid = {classification_version_sid}
         and accession = '{family_id}';
-        """.format(classification_version_sid=self.classification_version_sid, family_id=family_id)
+        """
 
-        results = self.db_caller.run_cmd_line_args(query.rstrip(), no_header_footer=True)
+        results = self.db_caller.run_query(query.rstrip(), self.query_variables(family_id=family_id))
         if len(results[1:]) > 0:
             return results[1][0]
         else:
@@ -93,27 +111,33 @@ class PthrCommentHelper:
 
     def get_comments(self, family_id):
         # Return record
-        query = """
-        select cm.* from panther_upl.{comments_tablename} cm
-        join panther_upl.classification c on c.classification_id = cm.classification_id
-        where c.classification_version_sid = {classification_version_sid}
-        and c.accession = '{family_id}';
-        """.format(comments_tablename=self.comments_tablename,
-                   classification_version_sid=self.classification_version_sid, family_id=family_id)
-
         # print(query)
-        results = self.db_caller.run_cmd_line_args(query.rstrip(), no_header_footer=True)
+        results = self.db_caller.run_query(COMMENTS_QUERY.rstrip(), self.query_variables(family_id=family_id))
         return parse_results_to_comments(results[1:])
 
+    def get_comments_for_families(self, family_ids: List[str], concurrency=DEFAULT_CONCURRENCY):
+        # get_comments over many families with up to concurrency queries in flight. Returns {family_id: [Comment]}
+        async_caller = AsyncDBCaller(self.db_caller.config, concurrency=concurrency)
+
+        async def fetch_comments():
+            try:
+                return await async_caller.run_queries(COMMENTS_QUERY.rstrip(),
+                                                      [self.query_variables(family_id=f) for f in family_ids])
+            finally:
+                async_caller.close()
+
+        family_results = asyncio.run(fetch_comments())
+        return {f: parse_results_to_comments(results[1:]) for f, results in zip(family_ids, family_results)}
+
     def update_comment(self, family_cls_id, comment_text):
         # Append to remark field
         query = """
         update panther_upl.{comments_tablename} cm
-        set remark = remark || '\n' || current_date || ': {comment_text}\n'
+        set remark = remark || '\n' || current_date || ': ' || {comment_text} || '\n'
         where cm.classification_id = {family_cls_id};
-        """.format(comments_tablename=self.comments_tablename, comment_text=comment_text, family_cls_id=family_cls_id)
+        """
 
-        self.db_caller.run_cmd_line_args(query.rstrip(), no_header_footer=True)
+        self.db_caller.run_query(query.rstrip(), self.query_variables(comment_text=comment_text, family_cls_id=family_cls_id))
 
     def insert_comment(self, family_cls_id, comment_text):
         # Insert new comment
@@ -121,10 +145,10 @@ class PthrCommentHelper:
         insert into panther_upl.{comments_tablename}
         (comment_id, classification_id, protein_id, remark, created_by, 
             creation_date, obsoleted_by, obsolescence_date, node_id)
-        VALUES (nextval('uids'), {family_cls_id}, null, current_date || ': {comment_text}\n', 1113, now(), null, null, null);
-        """.format(comments_tablename=self.comments_tablename, family_cls_id=family_cls_id, comment_text=comment_text)
+        VALUES (nextval('uids'), {family_cls_id}, null, current_date || ': ' || {comment_text} || '\n', 1113, now(), null, null, null);
+        """
 
-        self.db_caller.run_cmd_line_args(query.rstrip(), no_header_footer=True)
+        self.db_caller.run_query(query.rstrip(), self.query_variables(comment_text=comment_text, family_cls_id=family_cls_id))
 
     def update_or_insert_comment(self, family_id, comment_text):
         existing_comments = self.get_comments(family_id)
@@ -137,6 +161,62 @@ class PthrCommentHelper:
             cls_id = self.get_family_classification_id(family_id)
             self.insert_comment(cls_id, comment_text)
 
+    def get_family_classification_ids(self, connection, family_ids: List[str]):
+        # Resolve many families in one query. Families without a classification are absent from the returned dict.
+        query = """
+        select accession, classification_id from panther_upl.classification
+        where classification_version_sid = %s
+        and accession = any(%s);
+        """
+        cursor = connection.cursor()
+        cursor.execute(query, (self.classification_version_sid, list(family_ids)))
+        return dict(cursor.fetchall())
+
+    def update_or_insert_comments(self, family_comments: Dict[str, str]):
+        # Bulk version of update_or_insert_comment taking {family_id: comment_text}. All updates and inserts
+        #  are applied in a single transaction. Returns the family IDs skipped for having no classification.
+        with self.db_caller.connection() as con:
+            family_cls_ids = self.get_family_classification_ids(con, family_comments.keys())
+            cursor = con.cursor()
+            cursor.execute(sql.SQL("""
+            select distinct classification_id from panther_upl.{comments_tablename}
+            where classification_id = any(%s);
+            """).format(comments_tablename=sql.Identifier(self.comments_tablename)), (list(family_cls_ids.values()),))
+            commented_cls_ids = set(r[0] for r in cursor.fetchall())
+
+            missing_families = []
+            updates = []
+            inserts = []
+            for family_id, comment_text in family_comments.items():
+                cls_id = family_cls_ids.get(family_id)
+                if cls_id is None:
+                    missing_families.append(family_id)
+                    continue
+                remark = ": {}\n".format(comment_text)
+                if cls_id in commented_cls_ids:
+                    updates.append((cls_id, remark))
+                else:
+                    inserts.append((cls_id, remark))
+
+            if updates:
+                # Append to remark field
+                execute_values(cursor, sql.SQL("""
+                update panther_upl.{comments_tablename} cm
+                set remark = cm.remark || '\n' || current_date || v.remark
+                from (values %s) as v (classification_id, remark)
+                where cm.classification_id = v.classification_id;
+                """).format(comments_tablename=sql.Identifier(self.comments_tablename)), updates, page_size=1000)
+            if inserts:
+                execute_values(cursor, sql.SQL("""
+                insert into panther_upl.{comments_tablename}
+                (comment_id, classification_id, protein_id, remark, created_by,
+                    creation_date, obsoleted_by, obsolescence_date, node_id)
+                values %s;
+                """).format(comments_tablename=sql.Identifier(self.comments_tablename)), inserts,
+                               template="(nextval('uids'), %s, null, current_date || %s, 1113, now(), null, null, null)",
+                               page_size=1000)
+        return missing_families
+
     # TODO: Standardize annotation comment lines from annotation query
     # def generate_comments_by_query(self, query, comment_header):
     #     families = parse_results_to_fam_data_struct(results[1:])
@@ -0,0 +1,107 @@
+import hashlib
+import os
+import pickle
+import re
+import struct
+import time
+import zlib
+
+DEFAULT_TTL = 24 * 60 * 60  # seconds
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+CACHE_FILE_SUFFIX = ".qrc"
+# Cache file layout: creation timestamp (little-endian double) followed by the zlib-compressed pickle of the
+#  result rows (column name list first, as returned by DBCaller.exec_query).
+HEADER_FORMAT = "<d"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+# Quoted literals, quoted identifiers and dollar-quoted strings, as tokenized by DBCaller.bind_query
+QUOTED_TEXT_PATTERN = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|\$(?P<tag>(?:[A-Za-z_]\w*)?)\$[\s\S]*?\$(?P=tag)\$")
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def normalize_query(query):
+    # Collapse whitespace and drop the trailing ';', leaving quoted text untouched
+    query = query.strip().rstrip(";")
+    parts = []
+    last_end = 0
+    for quoted in QUOTED_TEXT_PATTERN.finditer(query):
+        parts.append(WHITESPACE_PATTERN.sub(" ", query[last_end:quoted.start()]))
+        parts.append(quoted.group(0))
+        last_end = quoted.end()
+    parts.append(WHITESPACE_PATTERN.sub(" ", query[last_end:]))
+    return "".join(parts).strip()
+
+
+class QueryResultCache:
+    """
+    On-disk cache of read-only query results, one file per query, keyed on the normalized query text and the
+    DB definition (host, dbname, username) it ran against. Entries older than ttl seconds are ignored and
+    removed; once the cache grows past max_bytes the least recently used entries are evicted.
+    """
+
+    def __init__(self, cache_dir, ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, config, query, params=None):
+        key_text = "\0".join([str(config.host), str(config.dbname), str(config.username), normalize_query(query)])
+        if params:
+            key_text += "\0" + repr(tuple(params))
+        return hashlib.sha256(key_text.encode("utf-8")).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key + CACHE_FILE_SUFFIX)
+
+    def get(self, key):
+        entry_path = self.entry_path(key)
+        try:
+            with open(entry_path, "rb") as cf:
+                created, = struct.unpack(HEADER_FORMAT, cf.read(HEADER_SIZE))
+                if time.time() - created > self.ttl:
+                    results = None
+                else:
+                    results = pickle.loads(zlib.decompress(cf.read()))
+        except FileNotFoundError:
+            return None
+        if results is None:
+            self.remove(entry_path)
+            return None
+        os.utime(entry_path)  # mtime tracks last use for eviction
+        return results
+
+    def set(self, key, results):
+        entry_path = self.entry_path(key)
+        tmp_path = "{}.{}.tmp".format(entry_path, os.getpid())
+        with open(tmp_path, "wb") as cf:
+            cf.write(struct.pack(HEADER_FORMAT, time.time()))
+            cf.write(zlib.compress(pickle.dumps(results, protocol=pickle.HIGHEST_PROTOCOL)))
+        os.replace(tmp_path, entry_path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total_bytes = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(CACHE_FILE_SUFFIX):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total_bytes += stat.st_size
+        entries.sort()
+        for mtime, size, entry_path in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            self.remove(entry_path)
+            total_bytes -= size
+
+    def clear(self):
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(CACHE_FILE_SUFFIX):
+                self.remove(entry.path)
+
+    @staticmethod
+    def remove(entry_path):
+        try:
+            os.remove(entry_path)
+        except FileNotFoundError:
+            pass  # Already removed by another process
@@ -0,0 +1,49 @@
+import datetime
+import itertools
+import json
+import threading
+
+
+def new_profile(query, mode):
+    # Timings in seconds. rows is the number of rows returned, or affected for insert/update/etc. bytes counts
+    #  the formatted output written for the statement.
+    # Outside stream mode the client-side cursor receives every row during execute, so execute_seconds includes
+    #  transferring the results and fetch_seconds only covers reading the already buffered rows. Server-side time
+    #  is in server_seconds ("Execution Time" of the EXPLAIN ANALYZE plan), which is only set with --explain.
+    return {
+        "query": query.strip(),
+        "mode": mode,
+        "execute_seconds": 0.0,
+        "fetch_seconds": 0.0,
+        "server_seconds": None,
+        "format_seconds": 0.0,
+        "total_seconds": 0.0,
+        "rows": None,
+        "bytes": 0,
+    }
+
+
+class QueryProfileLog:
+    """
+    JSON-lines log of per-statement profiles recorded by DBCaller.run_cmd_line_args, one record per statement
+    in execution order.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.log_f = open(filename, "a")
+        self.lock = threading.Lock()
+        self.statement_ids = itertools.count()
+
+    def write(self, profile, config=None):
+        record = {"statement": next(self.statement_ids), "timestamp": datetime.datetime.now().isoformat()}
+        if config is not None:
+            record["host"] = config.host
+            record["dbname"] = config.dbname
+        record.update(profile)
+        with self.lock:
+            self.log_f.write(json.dumps(record, default=str) + "\n")
+            self.log_f.flush()
+
+    def close(self):
+        self.log_f.close()
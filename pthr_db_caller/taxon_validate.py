@@ -1,7 +1,10 @@
 from Bio import Phylo
 import csv
 import argparse
+import json
 import logging
+import re
+import numpy
 
 logger = logging.getLogger(__name__)
 logger.setLevel("DEBUG")
@@ -19,6 +22,15 @@ parser_n.add_argument("-g", "--term", type=str)
 parser_n.set_defaults(function="taxon_term_lookup")
 
 THE_REST = []
+# Terms not valid for LUCA (virus stuff), until the table has LUCA's real values
+LUCA_INVALID_TERMS = ("GO:0019012", "GO:0039679", "GO:0044423")
+# Taxon-term tables saved by TaxonTermValidator.save_constraint_matrix, loaded memory-mapped
+CONSTRAINT_MATRIX_SUFFIX = ".npy"
+LABELS_FILE_SUFFIX = ".labels.json"
+# Terms per block of rows written by append_species_to_table
+TABLE_CHUNK_TERMS = 1000
+# Terms with these characters go through csv quoting
+CSV_SPECIAL_CHARS = re.compile(r'[\t"\r\n]')
 
 
 def extract_clade_name(clade_comment):
@@ -63,11 +75,21 @@ def find_taxon_clade(taxon_name, root_clade):
 
 
 class TaxonTermValidator:
+    """
+    Taxon-term table as a bit-packed matrix: constraints[term_indexes[term], taxon_indexes[taxon] // 8] holds the
+    table value ('0' -> 0, anything else -> 1) in bit 7 - taxon_indexes[taxon] % 8. taxon_term_table is either the
+    gaferencer TSV (GO term rows, taxon columns) or a matrix saved by save_constraint_matrix (CONSTRAINT_MATRIX_SUFFIX),
+    which is memory-mapped rather than read.
+    """
     def __init__(self, taxon_term_table, panther_tree_nhx=None, slim_terms=None):
-        self.term_constraint_lists = {}
+        self.term_indexes = {}
         self.taxon_indexes = {}
+        self.constraints: numpy.ndarray = None
         self.slim_terms = []
         self.tree = None
+        # Built by resolve_taxon, see build_taxon_ancestry
+        self.taxon_ancestry = None
+        self.taxon_ancestry_rest_size = None
 
         if slim_terms:
             # Get list of slim terms to filter for
@@ -75,7 +97,24 @@ class TaxonTermValidator:
             for t in slim_file.readlines():
                 self.slim_terms.append(t.rstrip())
             slim_file.close()
-        
+
+        if taxon_term_table.endswith(CONSTRAINT_MATRIX_SUFFIX):
+            self.load_constraint_matrix(taxon_term_table)
+        else:
+            self.read_taxon_term_table(taxon_term_table)
+
+        logger.debug("taxon_indexes: {}".format(len(self.taxon_indexes)))
+        logger.debug("term_indexes: {}".format(len(self.term_indexes)))
+
+        # Parse species_tree
+        if panther_tree_nhx:
+            self.tree = next(Phylo.parse(panther_tree_nhx, "newick"))
+            self.tree.clade.name, self.tree.clade.id = extract_clade_name(self.tree.clade.comment)
+            name_children(self.tree.clade)
+
+    def read_taxon_term_table(self, taxon_term_table):
+        slim_terms = set(self.slim_terms)
+        packed_rows = []
         with open(taxon_term_table) as t3f:
             header = t3f.readline().rstrip()
             headers = header.split("\t")
@@ -83,21 +122,42 @@ class TaxonTermValidator:
             for h in headers[1:len(headers)]:
                 self.taxon_indexes[h] = index_count
                 index_count += 1
+            taxon_count = len(self.taxon_indexes)
 
-            for l in t3f.readlines():
-                cols = l.split("\t")
-                go_term = cols[0]
-                if len(self.slim_terms) == 0 or go_term in self.slim_terms:
-                    self.term_constraint_lists[go_term] = cols[1:len(cols)]
+            for l in t3f:
+                go_term, sep, values = l.rstrip("\r\n").partition("\t")
+                if len(slim_terms) == 0 or go_term in slim_terms:
+                    row = numpy.zeros(taxon_count, dtype=bool)
+                    if len(values) == 2 * taxon_count - 1:
+                        # Single character values: every other byte
+                        row[:] = numpy.frombuffer(values.encode(), dtype=numpy.uint8)[::2] != ord("0")
+                    else:
+                        cols = values.split("\t")[:taxon_count]
+                        row[:len(cols)] = numpy.array(cols) != "0"
+                    if go_term not in self.term_indexes:
+                        self.term_indexes[go_term] = len(packed_rows)
+                        packed_rows.append(None)
+                    packed_rows[self.term_indexes[go_term]] = numpy.packbits(row)
+        if packed_rows:
+            self.constraints = numpy.vstack(packed_rows)
+        else:
+            self.constraints = numpy.zeros((0, (taxon_count + 7) // 8), dtype=numpy.uint8)
 
-        logger.debug("taxon_indexes: {}".format(len(self.taxon_indexes)))
-        logger.debug("term_constraint_lists: {}".format(len(self.term_constraint_lists)))
+    def save_constraint_matrix(self, matrix_file):
+        # Matrix to matrix_file (.npy), term and taxon labels to matrix_file + LABELS_FILE_SUFFIX
+        numpy.save(matrix_file, self.constraints)
+        with open(matrix_file + LABELS_FILE_SUFFIX, "w") as labels_f:
+            json.dump({"terms": list(self.term_indexes), "taxa": list(self.taxon_indexes)}, labels_f)
 
-        # Parse species_tree
-        if panther_tree_nhx:
-            self.tree = next(Phylo.parse(panther_tree_nhx, "newick"))
-            self.tree.clade.name, self.tree.clade.id = extract_clade_name(self.tree.clade.comment)
-            name_children(self.tree.clade)
+    def load_constraint_matrix(self, matrix_file):
+        with open(matrix_file + LABELS_FILE_SUFFIX) as labels_f:
+            labels = json.load(labels_f)
+        self.taxon_indexes = {taxon: i for i, taxon in enumerate(labels["taxa"])}
+        self.constraints = numpy.load(matrix_file, mmap_mode="r")
+        term_rows = [i for i, term in enumerate(labels["terms"]) if len(self.slim_terms) == 0 or term in self.slim_terms]
+        if len(term_rows) < len(labels["terms"]):
+            self.constraints = self.constraints[term_rows]
+        self.term_indexes = {labels["terms"][i]: row for row, i in enumerate(term_rows)}
 
     # This is used to replace NCBITaxon:##### column labels with species codes used in PANTHER and PAINT
     def replace_taxon_header_labels(self, new_label_lookup: dict):
@@ -114,68 +174,110 @@ class TaxonTermValidator:
         # Need to rerun gaferencer to include this taxon, then convert "cellular organisms" header to "LUCA" in
         # taxon_to_oscode.py
         # print(taxon)
-        while taxon in THE_REST and taxon != "LUCA":
-            # print(taxon)
-            # Get parent of taxon - handy BioPython trick
-            taxon_clade = find_taxon_clade(taxon, self.tree.clade)
-            node_path = self.tree.get_path(taxon_clade)
-            if len(node_path) > 1:
-                parent_clade = node_path[-2]
-            else:
-                parent_clade = self.tree.clade
-            taxon = parent_clade.name
+        taxon = self.resolve_taxon(taxon)
 
         # Remove after getting LUCA's real values - assuming most everything is cool with LUCA
         if taxon == "LUCA":
-            # virus stuff
-            if term in ("GO:0019012", "GO:0039679", "GO:0044423"):
-                return False
-            else:
-                return True
-
-        try:
-            result = self.taxon_term_lookup(taxon, term)
-        except IndexError:
-            print(taxon)
-            result = self.taxon_term_lookup(taxon, term)
-        if result == '0':
-            return False
-        return True
+            return term not in LUCA_INVALID_TERMS
+
+        return self.taxon_term_lookup(taxon, term) != '0'
+
+    def validate_many(self, taxa, terms):
+        """
+        validate_taxon_term for every taxon and term combination at once
+        :return: Boolean numpy array, one row per taxon and one column per term
+        """
+        resolved_taxa = [self.resolve_taxon(taxon) for taxon in taxa]
+        is_luca = numpy.array([taxon == "LUCA" for taxon in resolved_taxa], dtype=bool)
+        taxon_columns = numpy.array([self.taxon_indexes[taxon] if taxon != "LUCA" else 0 for taxon in resolved_taxa],
+                                    dtype=numpy.intp)
+        term_rows = numpy.array([self.term_indexes[term] for term in terms], dtype=numpy.intp)
+        results = self.constraint_bits(term_rows, taxon_columns).T.astype(bool)
+        results[is_luca] = ~numpy.isin(numpy.array(terms, dtype=object), LUCA_INVALID_TERMS)
+        return results
+
+    def constraint_bits(self, term_rows, taxon_columns):
+        # uint8 0/1 matrix of table values, one row per term row and one column per taxon column
+        packed = self.constraints[numpy.ix_(term_rows, taxon_columns >> 3)]
+        return (packed >> (7 - (taxon_columns & 7)).astype(numpy.uint8)) & 1
+
+    def build_taxon_ancestry(self):
+        # Map each species tree taxon to the taxon validate_taxon_term looks up in the table for it: itself, or if
+        #  it's in THE_REST (no table column), its nearest ancestor that isn't, stopping at LUCA. A taxon name found
+        #  on several clades takes its first clade in preorder, as find_taxon_clade does.
+        parent_names = {}
+        if self.tree is not None:
+            stack = [(self.tree.clade, self.tree.clade)]
+            while stack:
+                clade, parent_clade = stack.pop()
+                if clade.name not in parent_names:
+                    parent_names[clade.name] = parent_clade.name
+                stack.extend((c, clade) for c in reversed(clade.clades))
+        rest = set(THE_REST)
+        self.taxon_ancestry = {}
+        for name in parent_names:
+            path = []
+            taxon = name
+            while taxon not in self.taxon_ancestry and taxon in rest and taxon != "LUCA" and taxon not in path:
+                path.append(taxon)
+                taxon = parent_names.get(taxon, taxon)
+            resolved = self.taxon_ancestry.get(taxon, taxon)
+            for path_taxon in path or [name]:
+                self.taxon_ancestry[path_taxon] = resolved
+        self.taxon_ancestry_rest_size = len(THE_REST)
+
+    def resolve_taxon(self, taxon):
+        # Rebuilt whenever taxa have been added to THE_REST
+        if self.taxon_ancestry is None or self.taxon_ancestry_rest_size != len(THE_REST):
+            self.build_taxon_ancestry()
+        return self.taxon_ancestry.get(taxon, taxon)
 
     def taxon_term_lookup(self, taxon, term):
-        return self.term_constraint_lists[term][self.taxon_indexes[taxon]]
+        # Table value as '0' or '1'
+        taxon_index = self.taxon_indexes[taxon]
+        return str((self.constraints[self.term_indexes[term], taxon_index >> 3] >> (7 - (taxon_index & 7))) & 1)
 
 
 def append_species_to_table(validator : TaxonTermValidator, output_file):
     # List hyphenated species
-    # Reconstruct entire table file
-    # with open("new_table_file", "w+") as nf:
+    # Reconstruct entire table file. Columns for THE_REST taxa are copies of their resolved ancestors' columns,
+    #  gathered from the constraint matrix TABLE_CHUNK_TERMS terms at a time.
+    taxa = list(validator.taxon_indexes.keys()) + THE_REST
+    terms = list(validator.term_indexes)
+    if len(validator.slim_terms) > 0:
+        slim_terms = set(validator.slim_terms)
+        terms = [term for term in terms if term in slim_terms]
     with open(output_file, "w+") as nf:
         writer = csv.writer(nf, delimiter="\t")
-        header = ["GOterm"]
-        out_term_values = {}
-        for tk in list(validator.taxon_indexes.keys()) + THE_REST:
-            header.append(tk)
-            for term in validator.term_constraint_lists:
-                if validator.validate_taxon_term(tk, term):
-                    result = 1
+        writer.writerow(["GOterm"] + taxa)
+        if not taxa:
+            return
+        for chunk_start in range(0, len(terms), TABLE_CHUNK_TERMS):
+            chunk_terms = terms[chunk_start:chunk_start + TABLE_CHUNK_TERMS]
+            results = validator.validate_many(taxa, chunk_terms).T
+            # Row text after the term: '0'/'1' cells separated by tabs, then the csv line terminator
+            cells = numpy.full((len(chunk_terms), 2 * len(taxa)), ord("\t"), dtype=numpy.uint8)
+            cells[:, ::2] = results + ord("0")
+            row_text = cells.tobytes().decode("ascii")
+            row_size = 2 * len(taxa)
+            lines = []
+            for i, term in enumerate(chunk_terms):
+                if CSV_SPECIAL_CHARS.search(term):
+                    nf.write("".join(lines))
+                    lines = []
+                    writer.writerow([term] + [int(r) for r in results[i]])
                 else:
-                    result = 0
-                if term in out_term_values:
-                    out_term_values[term].append(result)
-                else:
-                    out_term_values[term] = [term, result]
-
-        writer.writerow(header)
-        for otv in out_term_values:
-            if len(validator.slim_terms) == 0 or otv in validator.slim_terms:
-                writer.writerow(out_term_values[otv])
+                    lines.append(term + "\t" + row_text[i * row_size:(i + 1) * row_size - 1] +
+                                 writer.dialect.lineterminator)
+            nf.write("".join(lines))
 
 
 def get_all_species_from_tree(validator : TaxonTermValidator):
+    known_taxa = set(validator.taxon_indexes.keys()) | set(THE_REST)
     for c in validator.tree.find_clades():
-        if len(c.name) > 0 and c.name not in list(validator.taxon_indexes.keys()) + THE_REST:
+        if len(c.name) > 0 and c.name not in known_taxa:
             THE_REST.append(c.name)
+            known_taxa.add(c.name)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,179 @@
+import hashlib
+import mmap
+import os
+import struct
+from array import array
+from typing import List
+from pthr_db_caller.models.panther import NodeDatFile
+from pthr_db_caller.nhx import parse_confidence
+from pthr_db_caller.panther_tree_graph import PantherTreeGraph
+from pthr_db_caller.tree_index import TreeIndex
+
+CACHE_FILE_SUFFIX = ".ptgc"
+CACHE_MAGIC = b"PTGC"
+CACHE_VERSION = 1
+# Cache file layout, all little-endian:
+#  header: magic, version, node count, then mtime (ns) and size of the source tree file and of the node.dat file
+#   its PTNs came from (0, 0 if none)
+#  int32 arrays, one per TreeIndex array (INDEX_ARRAYS), then the float64 branch lengths (NaN for none)
+#  one section per string column (STRING_COLUMNS): uint8 presence flags, int32 character offsets into the
+#   column's text, then the UTF-8 text of all values
+#  every section starts on an 8-byte boundary
+HEADER_FORMAT = "<4sHxxIxxxxqqqq"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+INDEX_ARRAYS = ["parent", "child_offsets", "child_ids", "preorder", "pre", "subtree_end", "post", "postorder", "depth"]
+STRING_COLUMNS = ["name", "species", "long_id", "ptn", "node_type", "comment", "confidence"]
+
+
+def source_stat(filename):
+    if filename is None:
+        return 0, 0
+    stat = os.stat(filename)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def padded(data: bytes):
+    return data + b"\0" * (-len(data) % 8)
+
+
+class TreeCache:
+    """
+    Binary cache of parsed family trees (PantherTreeGraph.parse results), one file per tree file, node.dat file and
+    tree name combination. An entry is only used while the tree file (and node.dat, if used) have the size and
+    modification time they had when it was written. Entries are read through mmap, with arrays copied straight out
+    of the mapping, so loading skips Newick parsing, node.dat scanning and tree index building.
+    Trees whose node names repeat (see PantherTreeGraph.init_from_nhx) aren't cached.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def entry_path(self, tree_file, tree_name=None, node_file: NodeDatFile = None):
+        node_dat = os.path.abspath(node_file.filename) if node_file is not None else ""
+        key_text = "\0".join([os.path.abspath(tree_file), str(tree_name), node_dat])
+        key = hashlib.sha256(key_text.encode("utf-8")).hexdigest()[:32]
+        return os.path.join(self.cache_dir, "{}.{}{}".format(os.path.basename(tree_file), key, CACHE_FILE_SUFFIX))
+
+    def load(self, tree_file, tree_name=None, node_file: NodeDatFile = None):
+        # Cached tree if still valid, else parse the tree file and cache it
+        tree = self.get(tree_file, tree_name=tree_name, node_file=node_file)
+        if tree is None:
+            tree = PantherTreeGraph.parse(tree_file, tree_name=tree_name, node_file=node_file)
+            self.set(tree_file, tree, node_file=node_file)
+        return tree
+
+    def get(self, tree_file, tree_name=None, node_file: NodeDatFile = None):
+        entry_path = self.entry_path(tree_file, tree_name=tree_name, node_file=node_file)
+        try:
+            with open(entry_path, "rb") as cf:
+                with mmap.mmap(cf.fileno(), 0, access=mmap.ACCESS_READ) as cache_map:
+                    return self.read_entry(cache_map, tree_file, tree_name, node_file)
+        except (FileNotFoundError, ValueError):
+            # ValueError: empty file can't be mapped
+            return None
+
+    def read_entry(self, cache_map, tree_file, tree_name, node_file: NodeDatFile):
+        magic, version, node_count, *stats = struct.unpack_from(HEADER_FORMAT, cache_map)
+        if magic != CACHE_MAGIC or version != CACHE_VERSION:
+            return None
+        if stats != [*source_stat(tree_file), *source_stat(node_file.filename if node_file is not None else None)]:
+            return None
+        offset = HEADER_SIZE
+        arrays = {}
+        for array_name in INDEX_ARRAYS:
+            length = node_count
+            if array_name == "child_offsets":
+                length = node_count + 1
+            elif array_name == "child_ids":
+                length = arrays["child_offsets"][-1]
+            arrays[array_name], offset = self.read_array(cache_map, offset, "i", length)
+        branch_lengths, offset = self.read_array(cache_map, offset, "d", node_count)
+        columns = {}
+        for column in STRING_COLUMNS:
+            columns[column], offset = self.read_strings(cache_map, offset, node_count)
+
+        tree = PantherTreeGraph(tree_name)
+        names = columns["name"]
+        nodes = []
+        for i, name in enumerate(names):
+            attributes = {}
+            for column in ["species", "long_id", "ptn", "node_type"]:
+                if columns[column][i] is not None:
+                    attributes[column] = columns[column][i]
+            nodes.append((name, attributes))
+            if columns["ptn"][i] is not None:
+                tree.ptn_to_an[columns["ptn"][i]] = name
+                tree.an_to_ptn[name] = columns["ptn"][i]
+            branch_length = branch_lengths[i]
+            tree.branch_lengths[name] = None if branch_length != branch_length else branch_length
+            tree.comments[name] = columns["comment"][i]
+            if columns["confidence"][i] is not None:
+                tree.confidences[name] = parse_confidence(columns["confidence"][i])
+        tree.graph.add_nodes_from(nodes)
+        child_offsets = arrays["child_offsets"]
+        child_ids = arrays["child_ids"]
+        tree.graph.add_edges_from((names[i], names[c]) for i in range(node_count)
+                                  for c in child_ids[child_offsets[i]:child_offsets[i + 1]])
+        tree._index = TreeIndex.from_arrays(names, arrays)
+        return tree
+
+    @staticmethod
+    def read_array(cache_map, offset, typecode, length):
+        values = array(typecode)
+        end = offset + values.itemsize * length
+        values.frombytes(cache_map[offset:end])
+        return values, end + (-end % 8)
+
+    @staticmethod
+    def read_strings(cache_map, offset, length):
+        present = cache_map[offset:offset + length]
+        offset += length + (-length % 8)
+        char_offsets, offset = TreeCache.read_array(cache_map, offset, "i", length + 1)
+        text_size, = struct.unpack_from("<q", cache_map, offset)
+        offset += 8
+        text = cache_map[offset:offset + text_size].decode("utf-8")
+        offset += text_size + (-text_size % 8)
+        values = [text[char_offsets[i]:char_offsets[i + 1]] if present[i] else None for i in range(length)]
+        return values, offset
+
+    def set(self, tree_file, tree: PantherTreeGraph, node_file: NodeDatFile = None):
+        # Returns False for trees that can't be cached
+        if tree._phylo is not None or not tree.branch_lengths or len(tree) == 0:
+            return False
+        index = tree.index
+        node_count = len(index)
+        sections = [struct.pack(HEADER_FORMAT, CACHE_MAGIC, CACHE_VERSION, node_count, *source_stat(tree_file),
+                                *source_stat(node_file.filename if node_file is not None else None))]
+        for array_name in INDEX_ARRAYS:
+            sections.append(padded(getattr(index, array_name).tobytes()))
+        branch_lengths = [tree.branch_lengths.get(name) for name in index.names]
+        sections.append(padded(array("d", [float("nan") if b is None else b for b in branch_lengths]).tobytes()))
+        nodes = tree.graph.nodes
+        for column in STRING_COLUMNS:
+            if column == "name":
+                values = index.names
+            elif column == "comment":
+                values = [tree.comments.get(name) for name in index.names]
+            elif column == "confidence":
+                values = [tree.confidences.get(name) for name in index.names]
+                values = [None if v is None else str(v) for v in values]
+            else:
+                values = [nodes[name].get(column) for name in index.names]
+            sections.append(self.pack_strings(values))
+
+        entry_path = self.entry_path(tree_file, tree_name=tree.name, node_file=node_file)
+        tmp_path = "{}.{}.tmp".format(entry_path, os.getpid())
+        with open(tmp_path, "wb") as cf:
+            cf.writelines(sections)
+        os.replace(tmp_path, entry_path)
+        return True
+
+    @staticmethod
+    def pack_strings(values: List):
+        present = bytes(v is not None for v in values)
+        char_offsets = array("i", [0])
+        for v in values:
+            char_offsets.append(char_offsets[-1] + (len(v) if v is not None else 0))
+        text = "".join(v for v in values if v is not None).encode("utf-8")
+        return padded(present) + padded(char_offsets.tobytes()) + struct.pack("<q", len(text)) + padded(text)
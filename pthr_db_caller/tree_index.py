@@ -0,0 +1,208 @@
+from array import array
+from networkx import MultiDiGraph, NetworkXError
+from typing import List
+
+
+class TreeIndex:
+    """
+    Array-backed snapshot of a tree graph's topology, built in one pass so structural queries don't need graph
+    traversals. Nodes are numbered by position in names (graph.nodes() order for from_graph):
+      parent        - parent node number, -1 for a root
+      child_offsets - children of node i are child_ids[child_offsets[i]:child_offsets[i + 1]], in graph order
+      preorder      - node numbers in preorder; pre[i] is node i's position in it
+      postorder     - node numbers in postorder; post[i] is node i's position in it
+      subtree_end   - preorder position of node i's last descendant, so descendants of i are exactly the preorder
+                      positions pre[i] + 1 ... subtree_end[i]
+      leaf          - 1 for nodes without children
+      depth         - number of ancestors
+    The index doesn't track graph changes; PantherTreeGraph drops it whenever nodes are removed.
+    """
+
+    def __init__(self, names: List, children: List[List[int]]):
+        # children[i] - node numbers of node i's children
+        self.names = names
+        self.ids = {name: i for i, name in enumerate(self.names)}
+        node_count = len(self.names)
+        self.parent = array("i", [-1]) * node_count
+        self.child_offsets = array("i", [0]) * (node_count + 1)
+        self.child_ids = array("i")
+        for i, child_ids in enumerate(children):
+            self.child_ids.extend(child_ids)
+            for child_id in child_ids:
+                self.parent[child_id] = i
+            self.child_offsets[i + 1] = len(self.child_ids)
+        self.roots = [i for i in range(node_count) if self.parent[i] == -1]
+        self.leaf = bytearray(node_count)
+        for i in range(node_count):
+            if self.child_offsets[i] == self.child_offsets[i + 1]:
+                self.leaf[i] = 1
+
+        self.preorder = array("i")
+        depth = array("i", [0]) * node_count
+        stack = list(reversed(self.roots))
+        while stack:
+            i = stack.pop()
+            self.preorder.append(i)
+            for child_id in reversed(self.child_ids[self.child_offsets[i]:self.child_offsets[i + 1]]):
+                depth[child_id] = depth[i] + 1
+                stack.append(child_id)
+        self.pre = array("i", [0]) * node_count
+        for position, i in enumerate(self.preorder):
+            self.pre[i] = position
+        subtree_size = array("i", [1]) * node_count
+        for i in reversed(self.preorder):
+            if self.parent[i] >= 0:
+                subtree_size[self.parent[i]] += subtree_size[i]
+        self.subtree_end = array("i", [0]) * node_count
+        self.post = array("i", [0]) * node_count
+        self.postorder = array("i", [0]) * node_count
+        for i in range(node_count):
+            self.subtree_end[i] = self.pre[i] + subtree_size[i] - 1
+            # A node comes after its whole subtree in postorder and before each ancestor
+            self.post[i] = self.subtree_end[i] - depth[i]
+            self.postorder[self.post[i]] = i
+        self.depth = depth
+        # Euler tour and LCA table, built on the first lca query
+        self.euler = None
+        self.first = None
+        self.lca_table = None
+
+    @classmethod
+    def from_graph(cls, graph: MultiDiGraph):
+        names = list(graph.nodes())
+        ids = {name: i for i, name in enumerate(names)}
+        return cls(names, [[ids[child] for child in graph.successors(name)] for name in names])
+
+    @classmethod
+    def from_arrays(cls, names: List, arrays):
+        # Index from previously built arrays (e.g. read back by TreeCache), skipping the traversals
+        index = cls.__new__(cls)
+        index.names = names
+        index.ids = {name: i for i, name in enumerate(names)}
+        for array_name in ["parent", "child_offsets", "child_ids", "preorder", "pre", "subtree_end", "post",
+                           "postorder", "depth"]:
+            setattr(index, array_name, arrays[array_name])
+        index.roots = [i for i in index.preorder if index.parent[i] == -1]
+        index.leaf = bytearray(len(names))
+        for i in range(len(names)):
+            if index.child_offsets[i] == index.child_offsets[i + 1]:
+                index.leaf[i] = 1
+        index.euler = None
+        index.first = None
+        index.lca_table = None
+        return index
+
+    def __len__(self):
+        return len(self.names)
+
+    def node_id(self, node):
+        try:
+            return self.ids[node]
+        except KeyError:
+            raise NetworkXError("The node {} is not in the digraph.".format(node))
+
+    def root(self):
+        if self.roots:
+            return self.names[self.roots[0]]
+
+    def parent_of(self, node):
+        parent_id = self.parent[self.node_id(node)]
+        if parent_id >= 0:
+            return self.names[parent_id]
+
+    def children_of(self, node):
+        i = self.node_id(node)
+        return [self.names[c] for c in self.child_ids[self.child_offsets[i]:self.child_offsets[i + 1]]]
+
+    def is_leaf(self, node):
+        return self.leaf[self.node_id(node)] == 1
+
+    def is_ancestor(self, ancestor_node, descendant_node):
+        # Strict: a node isn't its own ancestor
+        a = self.node_id(ancestor_node)
+        d = self.node_id(descendant_node)
+        return self.pre[a] < self.pre[d] <= self.subtree_end[a]
+
+    def ancestor_ids(self, i):
+        # Nearest first
+        i = self.parent[i]
+        while i >= 0:
+            yield i
+            i = self.parent[i]
+
+    def descendant_ids(self, i):
+        # In preorder
+        return self.preorder[self.pre[i] + 1:self.subtree_end[i] + 1]
+
+    def ancestors_of(self, node):
+        return [self.names[a] for a in self.ancestor_ids(self.node_id(node))]
+
+    def descendants_of(self, node):
+        return [self.names[d] for d in self.descendant_ids(self.node_id(node))]
+
+    def leaves_of(self, node):
+        return [self.names[d] for d in self.descendant_ids(self.node_id(node)) if self.leaf[d]]
+
+    def build_lca(self):
+        # Euler tour (each node listed on entry and again after each child) plus a sparse table of the
+        #  shallowest node over every power-of-two tour window, for O(1) lowest common ancestor queries
+        self.euler = array("i")
+        self.first = array("i", [0]) * len(self)
+        for root_id in self.roots:
+            stack = [(root_id, self.child_offsets[root_id])]
+            self.first[root_id] = len(self.euler)
+            self.euler.append(root_id)
+            while stack:
+                i, next_child = stack[-1]
+                if next_child < self.child_offsets[i + 1]:
+                    stack[-1] = (i, next_child + 1)
+                    child_id = self.child_ids[next_child]
+                    self.first[child_id] = len(self.euler)
+                    self.euler.append(child_id)
+                    stack.append((child_id, self.child_offsets[child_id]))
+                else:
+                    stack.pop()
+                    if stack:
+                        self.euler.append(stack[-1][0])
+        depth = self.depth
+        self.lca_table = [self.euler]
+        window = 1
+        while window * 2 <= len(self.euler):
+            prev = self.lca_table[-1]
+            self.lca_table.append(array("i", [a if depth[a] <= depth[b] else b
+                                              for a, b in zip(prev, prev[window:])]))
+            window *= 2
+
+    def lca_id(self, a, b):
+        if self.lca_table is None:
+            self.build_lca()
+        start, end = self.first[a], self.first[b]
+        if start > end:
+            start, end = end, start
+        level = (end - start + 1).bit_length() - 1
+        row = self.lca_table[level]
+        x, y = row[start], row[end - (1 << level) + 1]
+        lca = x if self.depth[x] <= self.depth[y] else y
+        # In a forest the tour runs on from one tree into the next, where the shallowest node is a root of neither
+        if self.pre[lca] <= self.pre[a] <= self.subtree_end[lca] and self.pre[lca] <= self.pre[b] <= self.subtree_end[lca]:
+            return lca
+        return -1
+
+    def lca(self, node_a, node_b):
+        lca = self.lca_id(self.node_id(node_a), self.node_id(node_b))
+        if lca >= 0:
+            return self.names[lca]
+
+    def nodes_between(self, ancestor_node, descendant_node):
+        # Nodes on the path strictly between the two, nearest descendant_node first. Empty if ancestor_node isn't
+        #  an ancestor of descendant_node.
+        a = self.node_id(ancestor_node)
+        d = self.node_id(descendant_node)
+        if not self.pre[a] < self.pre[d] <= self.subtree_end[a]:
+            return []
+        nodes = []
+        i = self.parent[d]
+        while i != a:
+            nodes.append(self.names[i])
+            i = self.parent[i]
+        return nodes
@@ -0,0 +1,132 @@
+import csv
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict
+from pthr_db_caller.panther_tree_graph import PantherTreeGraph
+from pthr_db_caller.tree_cache import TreeCache
+
+SUMMARY_FIELDS = ["family", "status", "seconds", "nodes", "tree_file", "out_file", "message"]
+
+# Set once per worker process by init_worker, so the species list isn't sent along with every family
+WORKER_TAXON_LIST = None
+WORKER_TREE_CACHE = None
+
+
+def family_name(tree_file):
+    # PTHR10000.tree -> PTHR10000; books/PTHR10000/tree.tree -> PTHR10000
+    base_name = os.path.basename(tree_file)
+    if base_name == "tree.tree":
+        return os.path.basename(os.path.dirname(os.path.abspath(tree_file)))
+    if base_name.endswith(".tree"):
+        return base_name[:-len(".tree")]
+    return base_name
+
+
+def find_tree_files(tree_dir, tree_glob="*.tree"):
+    return sorted(glob.glob(os.path.join(tree_dir, tree_glob)))
+
+
+def init_worker(taxon_list, cache_dir=None):
+    global WORKER_TAXON_LIST, WORKER_TREE_CACHE
+    WORKER_TAXON_LIST = taxon_list
+    WORKER_TREE_CACHE = TreeCache(cache_dir) if cache_dir else None
+
+
+def tree_to_newick(tree_file, out_file, taxon_list: List = None, cache: TreeCache = None):
+    """
+    Parse (or load from cache), optionally prune, and write one family tree as Newick. Errors are caught and
+    reported in the result rather than raised, so one bad family doesn't stop a library run.
+    :return: Dict of SUMMARY_FIELDS for this family
+    """
+    start_time = time.perf_counter()
+    result = {"family": family_name(tree_file), "tree_file": tree_file, "out_file": out_file, "nodes": 0,
+              "message": ""}
+    try:
+        if cache is not None:
+            tree = cache.load(tree_file)
+        else:
+            tree = PantherTreeGraph.parse(tree_file=tree_file)
+        if taxon_list is not None:
+            tree.prune_species(taxon_list=taxon_list)
+        result["nodes"] = len(tree)
+        if len(tree) > 0:
+            tree.write(out_file)
+            result["status"] = "ok"
+        else:
+            result["status"] = "empty"
+            result["message"] = "Empty tree so nothing to write"
+    except Exception as e:
+        result["status"] = "error"
+        result["message"] = "{}: {}".format(e.__class__.__name__, e)
+    result["seconds"] = round(time.perf_counter() - start_time, 4)
+    return result
+
+
+def worker_tree_to_newick(tree_and_out_file):
+    tree_file, out_file = tree_and_out_file
+    return tree_to_newick(tree_file, out_file, taxon_list=WORKER_TAXON_LIST, cache=WORKER_TREE_CACHE)
+
+
+def process_tree_library(tree_files: List, out_dir, taxon_list: List = None, workers=None, chunksize=8,
+                         cache_dir=None):
+    """
+    Writes <out_dir>/<family>.newick for each tree file, spread over a pool of worker processes.
+    :param workers: Number of processes. Defaults to the CPU count
+    :param cache_dir: Load parsed trees from / save them to a TreeCache in this directory
+    :return: List of per-family result Dicts (see tree_to_newick), in tree_files order
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = [(tree_file, os.path.join(out_dir, family_name(tree_file) + ".newick")) for tree_file in tree_files]
+    if workers == 1:
+        init_worker(taxon_list, cache_dir)
+        return [worker_tree_to_newick(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(taxon_list, cache_dir)) as executor:
+        return list(executor.map(worker_tree_to_newick, jobs, chunksize=chunksize))
+
+
+def family_sf_assignments(tree_file, family_sf_seed: Dict, cache: TreeCache = None):
+    tree_name = family_name(tree_file)
+    if cache is not None:
+        tree = cache.load(tree_file, tree_name=tree_name)
+    else:
+        tree = PantherTreeGraph.parse(tree_file=tree_file, tree_name=tree_name)
+    tree.extract_sf_assignments(family_sf_seed)
+    return tree.an_to_sf
+
+
+def worker_family_sf_assignments(tree_and_seed):
+    tree_file, family_sf_seed = tree_and_seed
+    return family_sf_assignments(tree_file, family_sf_seed, cache=WORKER_TREE_CACHE)
+
+
+def extract_library_sf_assignments(tree_files: List, an_to_sf_seed: Dict, workers=None, chunksize=8,
+                                   cache_dir=None):
+    """
+    PantherTreeGraph.extract_sf_assignments over every family tree, spread over a pool of worker processes. Each
+    family is only sent its own part of an_to_sf_seed. Errors parsing a tree are raised.
+    :param an_to_sf_seed: SF by full AN ID ("PTHR10000:AN16") for all families
+    :return: New Dict of SF (or None) for every node in tree_files, plus all seed entries
+    """
+    family_seeds = {}
+    for an_id, sf in an_to_sf_seed.items():
+        family_seeds.setdefault(an_id.split(":", maxsplit=1)[0], {})[an_id] = sf
+    jobs = [(tree_file, family_seeds.get(family_name(tree_file), {})) for tree_file in tree_files]
+    an_to_sf = dict(an_to_sf_seed)
+    if workers == 1:
+        init_worker(None, cache_dir)
+        for family_an_to_sf in map(worker_family_sf_assignments, jobs):
+            an_to_sf.update(family_an_to_sf)
+        return an_to_sf
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(None, cache_dir)) as executor:
+        for family_an_to_sf in executor.map(worker_family_sf_assignments, jobs, chunksize=chunksize):
+            an_to_sf.update(family_an_to_sf)
+    return an_to_sf
+
+
+def write_summary(results: List[Dict], summary_file):
+    with open(summary_file, "w", newline="") as summary_f:
+        writer = csv.DictWriter(summary_f, fieldnames=SUMMARY_FIELDS, delimiter="\t")
+        writer.writeheader()
+        writer.writerows(results)
@@ -1,10 +1,17 @@
+import io
+import os
+import shutil
 import unittest
+import tempfile
 from typing import List
-from pthr_db_caller import db_caller
+from pthr_db_caller import db_caller, query_cache, columnar, query_profile, taxon_validate
 from pthr_db_caller.models.panther import RefProtPantherMapping, NodeDatFile
 from pthr_db_caller.models import paint, metadata, orthoxml
 from pthr_db_caller.models.refprot_file import RefProtGeneAccFile, RefProtIdmappingFile, RefProtFastaFile
 from pthr_db_caller.panther_tree_graph import PantherTreeGraph
+from pthr_db_caller.nhx import parse_nhx
+from pthr_db_caller import tree_library
+from pthr_db_caller.tree_cache import TreeCache
 
 
 class TestDbCaller(unittest.TestCase):
@@ -13,6 +20,181 @@ class TestDbCaller(unittest.TestCase):
         self.assertEqual(config.dbname, "fake_db")
         self.assertEqual(config.username, "postgres")
         self.assertEqual(config.host, "db_test.internet.biz")
+        self.assertEqual(config.pool_maxconn, db_caller.DEFAULT_POOL_MAXCONN)
+        self.assertEqual(config.query_variables["classification_version_sid"], 29)
+
+    def test_select_statement_detection(self):
+        self.assertTrue(db_caller.is_select_statement("\n select * from panther_upl.classification"))
+        self.assertTrue(db_caller.is_select_statement("WITH fams AS (select 1) select * from fams"))
+        self.assertFalse(db_caller.is_select_statement("update panther_upl.comments set remark = ''"))
+        self.assertFalse(db_caller.is_select_statement("selected_families"))
+        # SELECT INTO and data-modifying WITH can't go through a named cursor or COPY
+        self.assertFalse(db_caller.is_select_statement("select * into fams from panther_upl.classification"))
+        self.assertFalse(db_caller.is_select_statement("with x as (delete from panther_upl.comments returning *) "
+                                                       "select * from x"))
+
+    def test_parallel_statement_groups(self):
+        caller = db_caller.DBCaller(db_caller.DBCallerConfig(config_path="resources/test/db_config_test.yaml"))
+        query_text = """create table fams as select 1;
+        -- @parallel exports
+        select * from fams;
+        -- @parallel exports
+        select count(*) from fams;
+        drop table fams;"""
+        groups = caller.split_statement_groups(query_text)
+        self.assertEqual([g[0] for g in groups], [None, "exports", None])
+        self.assertEqual(len(groups[1][1]), 2)
+        # ';' in a comment doesn't split statements
+        query_text = """-- drop old stuff; then rebuild
+        select 1;
+        -- @parallel exports
+        select 2;"""
+        groups = caller.split_statement_groups(query_text)
+        self.assertEqual(groups, [(None, ["        select 1"]), ("exports", ["\n        select 2"])])
+        self.assertEqual([s for g in groups for s in g[1]], list(filter(None, caller.clean_file(query_text).split(";"))))
+
+    def test_prepared_statement_text(self):
+        class StubConnection:
+            pass
+
+        class StubCursor:
+            def __init__(self):
+                self.connection = StubConnection()
+                self.executed = []
+
+            def execute(self, query, params=None):
+                self.executed.append(query)
+
+        caller = db_caller.DBCaller(db_caller.DBCallerConfig(config_path="resources/test/db_config_test.yaml"))
+        cursor = StubCursor()
+        query, params = caller.bind_query("select * from organism where name like '%sapiens%' and taxon_id = {}", [9606])
+        caller.execute_prepared(cursor, query, params)
+        self.assertEqual(cursor.executed[0], "PREPARE pthr_db_caller_0 AS select * from organism where name like "
+                                             "'%sapiens%' and taxon_id = $1")
+        cursor = StubCursor()
+        query, params = caller.bind_query("select * from organism where name like '%sapiens%'")
+        self.assertIsNone(params)
+        caller.execute_prepared(cursor, query, params)
+        self.assertEqual(cursor.executed[0], "PREPARE pthr_db_caller_0 AS select * from organism where name like "
+                                             "'%sapiens%'")
+        self.assertEqual(cursor.executed[1], "EXECUTE pthr_db_caller_0;")
+
+    def test_bind_query_variables(self):
+        caller = db_caller.DBCaller(db_caller.DBCallerConfig(config_path="resources/test/db_config_test.yaml"))
+        query, params = caller.bind_query("select * from panther_upl.{tablename} where classification_version_sid = "
+                                          "{classification_version_sid} and accession = '{family_id}' and remark like '%PAINT%'",
+                                          {"tablename": "comments", "family_id": "PTHR10000"})
+        self.assertEqual(query, "select * from panther_upl.comments where classification_version_sid = %s "
+                                "and accession = %s and remark like '%%PAINT%%'")
+        self.assertEqual(params, [29, "PTHR10000"])
+        query, params = caller.bind_query("copy upl from '{load_dir}upl.tsv'")
+        self.assertEqual(query, "copy upl from '/where_is_data/data/upl.tsv'")
+        self.assertIsNone(params)
+        # Dollar-quoted bodies are substituted as text and doubled braces unescaped, as clean_query does
+        raw_query = "create function f() returns int as $$ select {n} $$ language sql; select '{{}}', {{x}} where {n} = {n}"
+        query, params = caller.bind_query(raw_query, {"n": 1})
+        self.assertEqual(query, "create function f() returns int as $$ select 1 $$ language sql; select '{}', {x} where 1 = %s")
+        self.assertEqual(params, [1])
+        self.assertEqual(query.replace("%s", "1"), caller.clean_query(raw_query, {"n": 1}))
+        query, params = caller.bind_query("select $body$ {{x}} $body$")
+        self.assertEqual(query, caller.clean_query("select $body$ {{x}} $body$"))
+
+    def test_bind_query_value_positions(self):
+        caller = db_caller.DBCaller(db_caller.DBCallerConfig(config_path="resources/test/db_config_test.yaml"))
+        query_variables = {"col": "accession", "ids": "1,2,3", "n": 10, "name": "PTHR10000"}
+        # Only bound after comparisons, LIMIT/OFFSET and inside VALUES
+        self.assertEqual(caller.bind_query("select * from fams where accession <> {name} and n >= {n} limit {n} offset {n}",
+                                           query_variables),
+                         ("select * from fams where accession <> %s and n >= %s limit %s offset %s",
+                          ["PTHR10000", 10, 10, 10]))
+        self.assertEqual(caller.bind_query("insert into fams values ({name}, {n}), ('PTHR10001', {n})", query_variables),
+                         ("insert into fams values (%s, %s), ('PTHR10001', %s)", ["PTHR10000", 10, 10]))
+        # Names, lists and fragments are substituted as text, as clean_query does
+        for raw_query in ["select {col} from fams", "select * from fams where id in ({ids})",
+                          "select * from fams order by {col}", "select {col}, count(*) from fams group by {col}",
+                          'select "{col}" from fams', "select * from fams where {col} = 'PTHR10000'",
+                          "insert into fams values (lower({name}))"]:
+            self.assertEqual(caller.bind_query(raw_query, query_variables),
+                             (caller.clean_query(raw_query, query_variables), None))
+
+    def test_write_results_matches_format_results(self):
+        import io
+        import datetime
+        from decimal import Decimal
+        caller = db_caller.DBCaller(config=db_caller.DBCallerConfig(config_path="resources/test/db_config_test.yaml"))
+        results = [["accession", "version", "count", "created", "score"]]
+        results += [("PTHR{}".format(i), None if i % 2 else 15, i, datetime.date(2020, 1, 1), Decimal("1.10")) for i in range(10)]
+        results += [("PTHR10000;SF1", Decimal("1.1"), -0.0, None, True), ()]
+        for delimiter in [";", "\\t", "::"]:
+            out = io.StringIO()
+            line_count = caller.write_results(results, rows_outfile=out, delimiter=delimiter)
+            self.assertEqual(line_count, len(results))
+            self.assertEqual(out.getvalue(), "".join(l + "\n" for l in caller.format_results(results, delimiter=delimiter)))
+
+
+class TestQueryResultCache(unittest.TestCase):
+    def test_read_only_detection(self):
+        self.assertTrue(db_caller.is_read_only_statement("select accession from panther_upl.classification"))
+        self.assertFalse(db_caller.is_read_only_statement("select nextval('uids')"))
+        self.assertFalse(db_caller.is_read_only_statement("select * into fams from panther_upl.classification"))
+
+    def test_cache_round_trip(self):
+        config = db_caller.DBCallerConfig(config_path="resources/test/db_config_test.yaml")
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = query_cache.QueryResultCache(cache_dir)
+            key = cache.key(config, "select  accession\nfrom classification where accession = 'PTHR10000  ';")
+            self.assertEqual(key, cache.key(config, "select accession from classification where accession = 'PTHR10000  '"))
+            self.assertNotEqual(key, cache.key(config, "select accession from classification where accession = 'PTHR10000'"))
+            # Whitespace inside dollar-quoted strings and quoted identifiers is significant too
+            self.assertNotEqual(cache.key(config, "select $$a  b$$"), cache.key(config, "select $$a b$$"))
+            self.assertNotEqual(cache.key(config, 'select "x  y" from fams'), cache.key(config, 'select "x y" from fams'))
+            self.assertEqual(cache.key(config, "select  $tag$a  b$tag$,\n\"x  y\""),
+                             cache.key(config, "select $tag$a  b$tag$, \"x  y\""))
+            self.assertIsNone(cache.get(key))
+            results = [["accession"], ("PTHR10000",)]
+            cache.set(key, results)
+            self.assertEqual(cache.get(key), results)
+            cache.ttl = -1
+            self.assertIsNone(cache.get(key))
+
+
+class TestQueryProfile(unittest.TestCase):
+    def test_profile_written_results(self):
+        import json
+        config = db_caller.DBCallerConfig(config_path="resources/test/db_config_test.yaml")
+        caller = db_caller.DBCaller(config=config)
+        with tempfile.TemporaryDirectory() as out_dir:
+            profile = query_profile.new_profile("select accession from classification", "text")
+            with open(out_dir + "/rows.txt", "w") as rows_outfile:
+                line_count = caller.write_results([["accession"], ("PTHR10000",)], rows_outfile=rows_outfile,
+                                                  profile=profile)
+            self.assertEqual(line_count, 2)
+            self.assertEqual(profile["bytes"], len("accession\nPTHR10000\n"))
+            profile_log = query_profile.QueryProfileLog(out_dir + "/profile.jsonl")
+            profile_log.write(profile, config=config)
+            profile_log.write(profile, config=config)
+            profile_log.close()
+            with open(out_dir + "/profile.jsonl") as log_f:
+                records = [json.loads(l) for l in log_f]
+            self.assertEqual([r["statement"] for r in records], [0, 1])
+            self.assertEqual(records[0]["dbname"], config.dbname)
+            self.assertEqual(records[0]["query"], "select accession from classification")
+
+
+class TestColumnarResultWriter(unittest.TestCase):
+    def test_npy_batches(self):
+        import numpy
+        description = [("accession", 1043), ("classification_id", columnar.INT8_OID)]
+        with tempfile.TemporaryDirectory() as out_dir:
+            npy_file = out_dir + "/classifications.npy"
+            writer = columnar.ColumnarResultWriter(npy_file, "npy", description)
+            writer.write_batch([("PTHR10000", 1), ("PTHR10013", 2)])
+            writer.write_batch([("PTHR123456", None)])
+            writer.close()
+            result = numpy.load(npy_file)
+        self.assertEqual(writer.row_count, 3)
+        self.assertEqual(list(result["accession"]), ["PTHR10000", "PTHR10013", "PTHR123456"])
+        self.assertTrue(numpy.isnan(result["classification_id"][2]))
 
 
 class TestRefProtMapping(unittest.TestCase):
@@ -69,6 +251,35 @@ class TestPantherTreeGraph(unittest.TestCase):
         n = tree.node("AN98")
         self.assertEqual("Bacillus", n.get("species"), msg="Species Bacillus not found for node AN98")
 
+    def test_nhx_parse(self):
+        nhx_tree = parse_nhx("(AN1:1.000,(AN3:2.000,AN4:1.363)0.9:1.081[&&NHX:Ev=1>0:ID=AN2])[&&NHX:Ev=0>1:S=Bacillales:ID=AN0];\n")
+        self.assertEqual(len(nhx_tree), 5)
+        self.assertEqual([nhx_tree.label[c] for c in nhx_tree.children[nhx_tree.root]], ["AN1", None])
+        internal = nhx_tree.children[nhx_tree.root][1]
+        self.assertEqual(nhx_tree.branch_length[internal], 1.081)
+        self.assertEqual(nhx_tree.confidence[internal], 0.9)
+        self.assertEqual(nhx_tree.comment[internal], "&&NHX:Ev=1>0:ID=AN2")
+        self.assertEqual(nhx_tree.comment[nhx_tree.root], "&&NHX:Ev=0>1:S=Bacillales:ID=AN0")
+
+    def test_lazy_phylo(self):
+        tree = PantherTreeGraph.parse(tree_file="resources/test/PTHR10013.divided.tree.00")
+        self.assertIsNone(tree._phylo)
+        self.assertEqual([c.name for c in tree.phylo.tree.root.clades], ["AN1", "AN2"])
+        self.assertEqual(tree.phylo.tree.root.clades[1].comment, "&&NHX:Ev=1>0:ID=AN2")
+
+    def test_write_newick(self):
+        tree = PantherTreeGraph.parse(tree_file="resources/test/PTHR10013.divided.tree.00")
+        newick_f = io.StringIO()
+        tree.write(newick_f)
+        self.assertIsNone(tree._phylo)
+        self.assertTrue(newick_f.getvalue().startswith("(STAA8_Q2FWU5:1,"))
+        self.assertTrue(newick_f.getvalue().endswith(")1:0[&&NHX:Ev=S];\n"))
+        # Written from the Phylo tree, once there is one
+        tree.phylo
+        phylo_newick_f = io.StringIO()
+        tree.write(phylo_newick_f)
+        self.assertEqual(phylo_newick_f.getvalue(), newick_f.getvalue())
+
     def test_pruning(self):
         tree = PantherTreeGraph.parse(tree_file="resources/test/PTHR10013.divided.tree.00")
         tree.prune_species(taxon_list=["STAA8", "BACCR"])  # The only two species in this tree
@@ -76,11 +287,166 @@ class TestPantherTreeGraph(unittest.TestCase):
         tree.prune_species(taxon_list=["HUMAN", "MOUSE"])
         self.assertEqual(len(tree), 0)  # Should prune all nodes in tree
 
+    def test_pruning_collapses_unary_nodes(self):
+        tree = PantherTreeGraph.parse(tree_file="resources/test/PTHR10013.divided.tree.00")
+        tree.prune_species(taxon_list=["BACCR"])
+        self.assertEqual(len(tree), 3)  # AN0 is left with one child (AN2), which becomes the root
+        self.assertEqual(tree.root(), "AN2")
+        self.assertEqual(tree.leaves(), ["AN3", "AN4"])
+        self.assertEqual(tree.phylo.tree.root.name, "AN2")
+        self.assertAlmostEqual(tree.phylo.tree.root.branch_length, 1.081)
+
+    def test_remove_node_write(self):
+        tree = PantherTreeGraph.parse(tree_file="resources/test/PTHR10013.divided.tree.00")
+        tree.remove_node("AN1")
+        newick_f = io.StringIO()
+        tree.write(newick_f)
+        self.assertEqual(newick_f.getvalue(), "(BACCR_Q81DE2:2,BACCR_Q81EQ8:1.363)1:1.081[&&NHX:Ev=D];\n")
+        tree = PantherTreeGraph.parse(tree_file="resources/test/PTHR10013.divided.tree.00")
+        tree.prune_up("AN1")
+        newick_f = io.StringIO()
+        tree.write(newick_f)
+        self.assertEqual(newick_f.getvalue(), "(BACCR_Q81DE2:2,BACCR_Q81EQ8:1.363)1:1.081[&&NHX:Ev=D];\n")
+
+    def test_tree_index(self):
+        tree = PantherTreeGraph.parse(tree_file="resources/test/PTHR10013.divided.tree.00")
+        self.assertEqual(tree.root(), "AN0")
+        self.assertEqual(tree.children("AN0"), ["AN1", "AN2"])
+        self.assertEqual(tree.parents("AN3"), ["AN2"])
+        self.assertEqual(tree.parents("AN0"), [])
+        self.assertEqual(tree.leaves(), ["AN1", "AN3", "AN4"])
+        self.assertEqual(tree.leaves("AN2"), ["AN3", "AN4"])
+        self.assertEqual(tree.ancestors("AN4"), ["AN2", "AN0"])
+        self.assertTrue(tree.is_ancestor("AN0", "AN4"))
+        self.assertFalse(tree.is_ancestor("AN1", "AN4"))
+        self.assertTrue(tree.is_leaf("AN1"))
+        self.assertEqual(tree.nodes_between("AN0", "AN4"), ["AN2"])
+        self.assertEqual(tree.nodes_between("AN1", "AN4"), [])
+        self.assertEqual(tree.common_ancestor("AN3", "AN4"), "AN2")
+        self.assertEqual(tree.common_ancestor("AN1", "AN4"), "AN0")
+        self.assertEqual(tree.common_ancestor("AN2", "AN4"), "AN2")
+        tree.remove_node("AN1")
+        self.assertEqual(tree.leaves(), ["AN3", "AN4"])
+        self.assertEqual(tree.common_ancestor("AN3", "AN4"), "AN2")
+
+    def test_tree_library(self):
+        tree_files = ["resources/test/PTHR10000.tree", "resources/test/PTHR10013.divided.tree.00", "resources/test/missing.tree"]
+        with tempfile.TemporaryDirectory() as out_dir:
+            results = tree_library.process_tree_library(tree_files, out_dir, taxon_list=["STAA8", "BACCR"], workers=1)
+            self.assertEqual([r["family"] for r in results], ["PTHR10000", "PTHR10013.divided.tree.00", "missing"])
+            self.assertEqual([r["status"] for r in results], ["ok", "ok", "error"])
+            self.assertEqual(results[1]["nodes"], 5)
+            with open(results[1]["out_file"]) as newick_f:
+                self.assertTrue(newick_f.read().startswith("(STAA8_Q2FWU5:1,"))
+            results = tree_library.process_tree_library(tree_files[:2], out_dir, taxon_list=["HUMAN"], workers=1)
+            self.assertEqual([r["status"] for r in results], ["empty", "empty"])
+
+    def test_sf_assignments(self):
+        tree = PantherTreeGraph.parse(tree_file="resources/test/PTHR10000.tree", tree_name="PTHR10000")
+        an2_child = tree.children("AN2")[0]
+        seed = {"PTHR10000:AN1": "SF1", "PTHR10000:AN2": "SF2"}
+        tree.extract_sf_assignments(dict(seed))
+        self.assertEqual(len(tree.an_to_sf), len(tree))
+        self.assertIsNone(tree.an_to_sf["PTHR10000:AN0"])
+        self.assertEqual(tree.an_to_sf["PTHR10000:" + an2_child], "SF2")
+        self.assertEqual(tree.an_to_sf["PTHR10000:" + tree.leaves("AN1")[-1]], "SF1")
+        tree_files = ["resources/test/PTHR10000.tree"]
+        library_an_to_sf = tree_library.extract_library_sf_assignments(tree_files, dict(seed, **{"PTHR10013:AN0": "SF1"}),
+                                                                       workers=1)
+        self.assertEqual(library_an_to_sf, dict(tree.an_to_sf, **{"PTHR10013:AN0": "SF1"}))
+
+    def test_tree_cache(self):
+        node_dat = NodeDatFile.parse("resources/test/node_PTHR10000.dat")
+        with tempfile.TemporaryDirectory() as cache_dir, tempfile.TemporaryDirectory() as tree_dir:
+            tree_file = os.path.join(tree_dir, "PTHR10000.tree")
+            shutil.copy("resources/test/PTHR10000.tree", tree_file)
+            cache = TreeCache(cache_dir)
+            self.assertIsNone(cache.get(tree_file, tree_name="PTHR10000", node_file=node_dat))
+            parsed = cache.load(tree_file, tree_name="PTHR10000", node_file=node_dat)
+            cached = cache.get(tree_file, tree_name="PTHR10000", node_file=node_dat)
+            self.assertEqual(list(cached.graph.nodes(data=True)), list(parsed.graph.nodes(data=True)))
+            self.assertEqual(list(cached.graph.edges()), list(parsed.graph.edges()))
+            self.assertEqual(cached.branch_lengths, parsed.branch_lengths)
+            self.assertEqual(cached.an_to_ptn.get("AN16"), "PTN004118870")
+            self.assertEqual(cached.ancestors("AN16"), parsed.ancestors("AN16"))
+            # Other tree name or node.dat file gets its own entry
+            self.assertIsNone(cache.get(tree_file))
+            # Edited tree file invalidates the entry
+            with open(tree_file, "a") as tf:
+                tf.write("\n")
+            self.assertIsNone(cache.get(tree_file, tree_name="PTHR10000", node_file=node_dat))
+
     def test_with_node_dat(self):
         node_dat = NodeDatFile.parse("resources/test/node_PTHR10000.dat")
         tree = PantherTreeGraph.parse(tree_file="resources/test/PTHR10000.tree", tree_name="PTHR10000", node_file=node_dat)
         self.assertEqual(tree.an_to_ptn.get("AN16"), "PTN004118870")
 
+    def test_node_dat_columns(self):
+        node_dat = NodeDatFile.parse("resources/test/node_PTHR10000.dat")
+        streamed = list(NodeDatFile.stream("resources/test/node_PTHR10000.dat"))
+        self.assertEqual(len(node_dat), len(streamed))
+        for entry, streamed_entry in zip(node_dat, streamed):
+            self.assertEqual((entry.an_id, entry.ptn, entry.node_type, entry.event_type, entry.branch_length),
+                             (streamed_entry.an_id, streamed_entry.ptn, streamed_entry.node_type,
+                              streamed_entry.event_type, streamed_entry.branch_length))
+        self.assertEqual(node_dat.ptn_to_an["PTN004118870"], "PTHR10000:AN16")
+        self.assertEqual(node_dat.an_to_ptn["PTHR10000:AN0"], "PTN000000084")
+        self.assertFalse(hasattr(streamed[0], "__dict__"))
+
+    def test_with_indexed_node_dat(self):
+        node_dat = NodeDatFile.index("resources/test/node_PTHR10000.dat")
+        self.assertEqual(node_dat.families(), ["PTHR10000"])
+        self.assertEqual(len(node_dat.family_entries("PTHR10000")), len(node_dat))
+        self.assertEqual(node_dat.family_entries("PTHR10013"), [])
+        tree = PantherTreeGraph.parse(tree_file="resources/test/PTHR10000.tree", tree_name="PTHR10000", node_file=node_dat)
+        self.assertEqual(tree.an_to_ptn.get("AN16"), "PTN004118870")
+
+
+class TestTaxonValidate(unittest.TestCase):
+    def test_taxon_ancestry(self):
+        with tempfile.TemporaryDirectory() as table_dir:
+            table_file = os.path.join(table_dir, "taxon_term_table.tsv")
+            with open(table_file, "w") as table_f:
+                table_f.write("GOterm\tEubacteria\tArchaea-Eukaryota\n")
+                table_f.write("GO:0005634\t0\t1\n")
+            validator = taxon_validate.TaxonTermValidator(table_file, "resources/test/species_pthr16_annot.nhx")
+            try:
+                taxon_validate.get_all_species_from_tree(validator)
+                self.assertEqual(validator.resolve_taxon("Eukaryota"), "Archaea-Eukaryota")
+                self.assertEqual(validator.resolve_taxon("Eubacteria"), "Eubacteria")
+                self.assertEqual(validator.resolve_taxon("LUCA"), "LUCA")
+                self.assertTrue(validator.validate_taxon_term("Archaea", "GO:0005634"))
+                self.assertFalse(validator.validate_taxon_term("Eubacteria", "GO:0005634"))
+            finally:
+                del taxon_validate.THE_REST[:]
+
+    def test_constraint_matrix(self):
+        with tempfile.TemporaryDirectory() as table_dir:
+            table_file = os.path.join(table_dir, "taxon_term_table.tsv")
+            with open(table_file, "w") as table_f:
+                table_f.write("GOterm\t" + "\t".join("T{}".format(i) for i in range(10)) + "\n")
+                table_f.write("GO:0005634\t1\t0\t1\t1\t1\t1\t1\t1\t0\t0\n")
+                table_f.write("GO:0019012\t0\t0\t0\t0\t0\t0\t0\t0\t0\t1\n")
+            validator = taxon_validate.TaxonTermValidator(table_file)
+            self.assertEqual(validator.taxon_term_lookup("T8", "GO:0005634"), "0")
+            self.assertEqual(validator.taxon_term_lookup("T9", "GO:0019012"), "1")
+            matrix_file = os.path.join(table_dir, "taxon_term_table.npy")
+            validator.save_constraint_matrix(matrix_file)
+            loaded = taxon_validate.TaxonTermValidator(matrix_file)
+            taxa = ["T0", "T1", "T9", "LUCA"]
+            terms = ["GO:0005634", "GO:0019012"]
+            expected = [[True, False], [False, False], [False, True], [True, False]]
+            self.assertEqual(validator.validate_many(taxa, terms).tolist(), expected)
+            self.assertEqual(loaded.validate_many(taxa, terms).tolist(), expected)
+            self.assertEqual([validator.validate_taxon_term(taxon, "GO:0005634") for taxon in taxa], [True, False, False, True])
+            out_file = os.path.join(table_dir, "expanded_table.tsv")
+            taxon_validate.append_species_to_table(validator, out_file)
+            with open(out_file) as out_f:
+                rows = [l.rstrip("\n").split("\t") for l in out_f]
+            self.assertEqual(rows[0], ["GOterm"] + ["T{}".format(i) for i in range(10)])
+            self.assertEqual(rows[1], ["GO:0005634", "1", "0", "1", "1", "1", "1", "1", "1", "0", "0"])
+            self.assertEqual(len(rows), 3)
+
 
 class TestXmlToGaf(unittest.TestCase):
     ASPECT_FILE = "resources/test/go_aspects.tsv"